@@ -0,0 +1,264 @@
+"""A local stand-in for bitbucket.org, for benchmarks that need no network.
+
+It serves, under one base URL:
+
+* the descendants pages scraped by ``bbforks`` (``/user/repo/descendants/``),
+  paginated like the real ones,
+* the parts of the 1.0 API used by hgbb (``/1.0/repositories/...``),
+* the repositories themselves through hgweb (``/user/repo``).
+
+Every request is delayed by a configurable latency.  Repositories with
+forks and followers are generated with :meth:`fakebitbucket.makerepo` and
+:meth:`fakebitbucket.makeforks`.
+"""
+
+import os
+import cgi
+import json
+import time
+import base64
+import threading
+import SocketServer
+from wsgiref import simple_server
+
+from mercurial import ui as uimod, hg, context
+from mercurial.hgweb import hgweb_mod
+
+WEBCONFIG = '''[web]
+push_ssl = False
+allow_push = *
+'''
+
+
+class fakebitbucket(object):
+    """WSGI application faking bitbucket for the repositories under ``root``
+    (stored as ``root/user/repo``)."""
+
+    def __init__(self, root, latency=0.0, pagesize=30, ratelimit=0):
+        self.root = root
+        self.latency = latency
+        self.pagesize = pagesize
+        # pages and API calls per second answered before throttling with 429
+        self.ratelimit = ratelimit
+        self._window = (0, 0)
+        self.throttled = 0
+        self.forks = {}
+        self.followers = {}
+        self.updated = {}
+        self._apps = {}
+        self._lock = threading.Lock()
+        self.ui = uimod.ui()
+        self.ui.setconfig('ui', 'quiet', 'True')
+        self.ui.setconfig('ui', 'username', 'bench <bench@example.com>')
+
+    # generating repositories
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def _create(self, name):
+        path = self.path(name)
+        repo = hg.repository(self.ui, path, create=True)
+        fp = open(os.path.join(path, '.hg', 'hgrc'), 'w')
+        fp.write(WEBCONFIG)
+        fp.close()
+        self.updated[name] = time.time()
+        return repo
+
+    def _commit(self, repo, count, prefix):
+        """Add ``count`` linear changesets on top of the tip of ``repo``."""
+        for i in xrange(count):
+            filename = '%s-%d.txt' % (prefix, i % 50)
+            data = '%s change %d\n' % (prefix, i)
+            def filectx(repo, memctx, path):
+                return context.memfilectx(path, data)
+            ctx = context.memctx(repo, (repo['tip'].node(), None),
+                                 '%s change %d' % (prefix, i), [filename],
+                                 filectx)
+            repo.commitctx(ctx)
+
+    def makerepo(self, name, history=100, followers=0):
+        """Create the repository ``name`` with ``history`` changesets."""
+        repo = self._create(name)
+        self._commit(repo, history, 'base')
+        self.followers[name] = [
+            dict(username='follower%d' % i, first_name='Follower',
+                 last_name=str(i))
+            for i in xrange(followers)]
+        return repo
+
+    def makeforks(self, name, count, changes=1, prefix='forker'):
+        """Create ``count`` forks of ``name``, each with ``changes``
+        changesets of its own, owned by ``prefix0``, ``prefix1``..."""
+        owner, reponame = name.split('/')
+        forks = self.forks.setdefault(name, [])
+        for i in xrange(count):
+            forkname = '%s%d/%s' % (prefix, i, reponame)
+            os.makedirs(os.path.dirname(self.path(forkname)))
+            hg.clone(self.ui, {}, self.path(name), self.path(forkname),
+                     update=False)
+            fp = open(os.path.join(self.path(forkname), '.hg', 'hgrc'), 'a')
+            fp.write(WEBCONFIG)
+            fp.close()
+            repo = hg.repository(self.ui, self.path(forkname))
+            self._commit(repo, changes, '%s%d' % (prefix, i))
+            # make some forks look dormant to activity filters
+            self.updated[forkname] = time.time() - i * 86400
+            forks.append(forkname)
+
+    # serving
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Serve in a background thread; return the base URL."""
+        server = simple_server.make_server(host, port, self,
+                                           server_class=threadingserver,
+                                           handler_class=quiethandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.server = server
+        return 'http://%s:%d' % server.server_address
+
+    def __call__(self, environ, start_response):
+        if self.latency:
+            time.sleep(self.latency)
+        path = environ.get('PATH_INFO', '').strip('/')
+        parts = path.split('/')
+        if (parts[0] == '1.0' or parts[-1] == 'descendants') and \
+                self.throttle():
+            start_response('429 Too Many Requests',
+                           [('Content-Type', 'text/plain'),
+                            ('Retry-After', '1')])
+            return ['slow down\n']
+        if parts[0] == '1.0':
+            return self.api(environ, start_response, parts[1:])
+        if len(parts) == 3 and parts[2] == 'descendants':
+            return self.descendants(environ, start_response, '/'.join(parts[:2]))
+        if len(parts) == 2 and os.path.isdir(self.path(path)):
+            return self.hgweb(environ, start_response, path)
+        return self.respond(start_response, '404 Not Found', 'not found\n')
+
+    def throttle(self):
+        """Count a request; return True if it goes over the rate limit."""
+        if not self.ratelimit:
+            return False
+        self._lock.acquire()
+        try:
+            second = int(time.time())
+            window, count = self._window
+            if window != second:
+                window, count = second, 0
+            self._window = (window, count + 1)
+            if count >= self.ratelimit:
+                self.throttled += 1
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def respond(self, start_response, status, body,
+                contenttype='text/plain'):
+        start_response(status, [('Content-Type', contenttype),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def hgweb(self, environ, start_response, name):
+        self._lock.acquire()
+        try:
+            app = self._apps.get(name)
+            if app is None:
+                app = self._apps[name] = hgweb_mod.hgweb(self.path(name),
+                                                         baseui=self.ui)
+        finally:
+            self._lock.release()
+        environ = dict(environ, SCRIPT_NAME='/' + name, PATH_INFO='')
+        return app(environ, start_response)
+
+    def descendants(self, environ, start_response, name):
+        if name not in self.forks and not os.path.isdir(self.path(name)):
+            return self.respond(start_response, '404 Not Found', 'not found\n')
+        query = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+        page = int(query.get('page', ['1'])[0])
+        forks = self.forks.get(name, [])
+        start = (page - 1) * self.pagesize
+        pageforks = forks[start:start + self.pagesize]
+        html = ['<html><body><div class="forks pane">', '<h2>Forks</h2>']
+        if pageforks:
+            html.append('<ol class="detailed iterable">')
+            for fork in pageforks:
+                user = fork.split('/')[0]
+                html.append('<li><dd class="name"><a href="/%s">%s</a> / '
+                            '<a href="/%s">%s</a></dd></li>'
+                            % (user, user, fork, fork))
+            html.append('</ol>')
+            if start + self.pagesize < len(forks):
+                html.append('<ol class="paginator"><li class="next">'
+                            '<a href="?page=%d">next</a></li></ol>'
+                            % (page + 1))
+        else:
+            html.append('<p>No forks of <a href="/%s">%s</a> yet.</p>'
+                        % (name, name))
+        html.append('<h2>Patch queues</h2></div></body></html>')
+        return self.respond(start_response, '200 OK', '\n'.join(html),
+                            'text/html')
+
+    def api(self, environ, start_response, parts):
+        if parts[0] != 'repositories':
+            return self.respond(start_response, '404 Not Found', 'not found\n')
+        if environ['REQUEST_METHOD'] == 'POST' and len(parts) == 1:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            form = cgi.parse_qs(environ['wsgi.input'].read(length))
+            owner = self.user(environ) or 'owner'
+            name = '%s/%s' % (owner, form['name'][0])
+            if os.path.isdir(self.path(name)):
+                return self.respond(start_response, '400 Bad Request',
+                                    'repository exists\n')
+            self._create(name)
+            return self.json(start_response, dict(slug=form['name'][0],
+                                                  owner=owner))
+        name = '/'.join(parts[1:3])
+        if not os.path.isdir(self.path(name)):
+            return self.respond(start_response, '404 Not Found', 'not found\n')
+        if len(parts) == 4 and parts[3] == 'followers':
+            query = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+            followers = self.followers.get(name, [])
+            start = int(query.get('start', ['0'])[0])
+            limit = int(query.get('limit', [str(len(followers))])[0])
+            return self.json(start_response, dict(
+                count=len(followers),
+                followers=followers[start:start + limit]))
+        if len(parts) == 3:
+            return self.json(start_response, self.metadata(name))
+        return self.respond(start_response, '404 Not Found', 'not found\n')
+
+    def metadata(self, name):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(self.path(name)):
+            size += sum(os.path.getsize(os.path.join(dirpath, f))
+                        for f in filenames)
+        updated = time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.gmtime(self.updated.get(name, 0)))
+        owner, slug = name.split('/')
+        return dict(owner=owner, slug=slug, scm='hg', size=size,
+                    last_updated=updated)
+
+    def json(self, start_response, data):
+        return self.respond(start_response, '200 OK', json.dumps(data),
+                            'application/json')
+
+    def user(self, environ):
+        auth = environ.get('HTTP_AUTHORIZATION', '')
+        if auth.startswith('Basic '):
+            return base64.b64decode(auth[6:]).split(':', 1)[0]
+
+
+class threadingserver(SocketServer.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections of concurrent clients,
+    # which then wait a second for the retry
+    request_queue_size = 128
+
+
+class quiethandler(simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Time hgbb commands against a local fake bitbucket (see fakebb.py).
+
+A repository ``owner/repo`` with the requested history, forks and followers
+is generated in a temporary directory and served locally; a clone of it with
+one local changeset is the working repository.  Every benchmark runs a real
+``hg`` process, and the time of the first run (with cold caches) is reported
+next to the fastest and mean times of all runs.
+
+Extra ``--config`` options are passed on to every hg command, so that
+settings can be compared, e.g.::
+
+    python bench/run.py --forks 100 --latency 20
+    python bench/run.py --forks 100 --latency 20 --config bb.fork_workers=8
+"""
+
+import os
+import sys
+import time
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakebb
+
+HGBB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    'hgbb.py')
+
+# name -> (function returning the hg arguments for run i, directory)
+BENCHMARKS = [
+    ('bbforks', lambda i: ['bbforks'], 'local'),
+    ('bbforks -i', lambda i: ['bbforks', '-i'], 'local'),
+    ('bbforks -o', lambda i: ['bbforks', '-o'], 'local'),
+    ('bbforks -o1', lambda i: ['bbforks', '-o', '--single-pass'], 'local'),
+    ('bbforks -r', lambda i: ['bbforks', '--recursive'], 'local'),
+    ('bbfollowers', lambda i: ['bbfollowers'], 'local'),
+    ('bbcreate', lambda i: ['bbcreate', 'created%d' % i], 'scratch'),
+    ('bb:// clone', lambda i: ['clone', 'bb://owner/repo', 'clone%d' % i],
+     'scratch'),
+]
+
+# files that make later runs of bbforks cheaper
+CACHES = ['bbforks.cache', 'bbforks.state', 'bbforks-cache']
+
+
+def setup(workdir, opts):
+    server = fakebb.fakebitbucket(os.path.join(workdir, 'server'),
+                                  latency=opts.latency / 1000.0,
+                                  pagesize=opts.page_size,
+                                  ratelimit=opts.server_rate_limit)
+    server.makerepo('owner/repo', history=opts.history,
+                    followers=opts.followers)
+    server.makeforks('owner/repo', opts.forks, changes=opts.fork_changes)
+    for i in xrange(opts.forks):
+        server.makeforks('forker%d/repo' % i, opts.subforks,
+                         changes=opts.fork_changes, prefix='forker%d-' % i)
+    baseurl = server.serve()
+
+    local = os.path.join(workdir, 'local')
+    fakebb.hg.clone(server.ui, {}, server.path('owner/repo'), local)
+    repo = fakebb.hg.repository(server.ui, local)
+    server._commit(repo, 1, 'local')
+    fp = open(os.path.join(local, '.hg', 'hgrc'), 'w')
+    fp.write('[paths]\ndefault = bb://owner/repo\n')
+    fp.close()
+    os.mkdir(os.path.join(workdir, 'scratch'))
+
+    hgrc = os.path.join(workdir, 'hgrc')
+    fp = open(hgrc, 'w')
+    fp.write('[ui]\nusername = bench\n'
+             '[extensions]\nhgbb = %s\n'
+             '[bb]\nusername = owner\npassword = secret\n'
+             'default_method = https\nurl = %s\napi_url = %s/1.0\n'
+             % (opts.extension, baseurl, baseurl))
+    fp.close()
+    return server, hgrc
+
+
+def runhg(opts, hgrc, cwd, args):
+    cmd = [opts.hg]
+    for config in opts.config:
+        cmd += ['--config', config]
+    env = dict(os.environ, HGRCPATH=hgrc, HGPLAIN='1')
+    start = time.time()
+    proc = subprocess.Popen(cmd + args, cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    elapsed = time.time() - start
+    if proc.returncode:
+        raise SystemExit('hg %s failed:\n%s' % (' '.join(args), output))
+    return elapsed
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--forks', type='int', default=20,
+                      help='number of forks (default 20)')
+    parser.add_option('--history', type='int', default=200,
+                      help='changesets in the main repository (default 200)')
+    parser.add_option('--subforks', type='int', default=0,
+                      help='forks of every fork (default 0)')
+    parser.add_option('--fork-changes', type='int', default=2,
+                      help='changesets of each fork (default 2)')
+    parser.add_option('--followers', type='int', default=50,
+                      help='followers of the main repository (default 50)')
+    parser.add_option('--latency', type='float', default=0,
+                      help='latency of every request in ms (default 0)')
+    parser.add_option('--page-size', type='int', default=30,
+                      help='forks per descendants page (default 30)')
+    parser.add_option('--server-rate-limit', type='int', default=0,
+                      help='pages and API calls per second the server '
+                      'answers before throttling (default: no limit)')
+    parser.add_option('-n', '--runs', type='int', default=3,
+                      help='runs of every benchmark (default 3)')
+    parser.add_option('--cold', action='store_true',
+                      help='remove the bbforks caches before every run')
+    parser.add_option('--only', action='append', default=[],
+                      help='only run the given benchmark (repeatable)')
+    parser.add_option('--config', action='append', default=[],
+                      help='config option passed to hg (repeatable)')
+    parser.add_option('--hg', default='hg', help='hg executable to use')
+    parser.add_option('--extension', default=HGBB,
+                      help='hgbb.py to load (default: the one of this tree)')
+    parser.add_option('--keep', action='store_true',
+                      help='keep the temporary directory')
+    parser.add_option('--serve', action='store_true',
+                      help='only set up and serve until interrupted')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hgbb-bench-')
+    try:
+        start = time.time()
+        server, hgrc = setup(workdir, opts)
+        print 'generated %d forks of %d changesets in %.1f s (%s)' % (
+            opts.forks, opts.history, time.time() - start, workdir)
+        if opts.serve:
+            print 'serving; use HGRCPATH=%s in %s' % (
+                hgrc, os.path.join(workdir, 'local'))
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                return
+        print '%-14s %10s %10s %10s' % ('', 'first (ms)', 'min (ms)',
+                                        'mean (ms)')
+        for name, makeargs, cwd in BENCHMARKS:
+            if opts.only and name not in opts.only:
+                continue
+            times = []
+            for i in xrange(opts.runs):
+                if opts.cold:
+                    for cache in CACHES:
+                        path = os.path.join(workdir, 'local', '.hg', cache)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        elif os.path.exists(path):
+                            os.unlink(path)
+                times.append(runhg(opts, hgrc, os.path.join(workdir, cwd),
+                                   makeargs(i)))
+            print '%-14s %10.1f %10.1f %10.1f' % (
+                name, times[0] * 1000, min(times) * 1000,
+                sum(times) / len(times) * 1000)
+        if opts.server_rate_limit:
+            print 'the server throttled %d requests' % server.throttled
+    finally:
+        if opts.keep:
+            print 'kept %s' % workdir
+        else:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
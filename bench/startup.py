@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Measure how much loading hgbb adds to the startup time of hg.
+
+The hg command (``version -q`` by default) is run alternately without and
+with the extension enabled, and the fastest and mean wall times of both
+are reported.  User configuration files are ignored (``HGRCPATH`` is
+cleared), so that only hgbb is measured.
+"""
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+HGBB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    'hgbb.py')
+
+
+def run(cmd, env):
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        subprocess.check_call(cmd, stdout=devnull, env=env)
+        return time.time() - start
+    finally:
+        devnull.close()
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [-n RUNS] [--hg HG] [hg command and arguments]')
+    parser.add_option('-n', '--runs', type='int', default=20,
+                      help='number of runs of each variant (default 20)')
+    parser.add_option('--hg', default='hg', help='hg executable to use')
+    parser.add_option('--extension', default=HGBB,
+                      help='hgbb.py to load (default: the one of this tree)')
+    opts, args = parser.parse_args()
+    args = args or ['version', '-q']
+
+    env = dict(os.environ, HGRCPATH='')
+    variants = [
+        ('baseline', [opts.hg] + args),
+        ('hgbb', [opts.hg, '--config', 'extensions.hgbb=' + opts.extension]
+                 + args),
+    ]
+    # one warm-up run each, so that both start with a warm disk cache
+    for name, cmd in variants:
+        run(cmd, env)
+    times = dict((name, []) for name, cmd in variants)
+    for i in xrange(opts.runs):
+        for name, cmd in variants:
+            times[name].append(run(cmd, env))
+
+    print 'hg %s, %d runs' % (' '.join(args), opts.runs)
+    print '%-10s %10s %10s' % ('', 'min (ms)', 'mean (ms)')
+    for name, cmd in variants:
+        t = times[name]
+        print '%-10s %10.1f %10.1f' % (name, min(t) * 1000,
+                                       sum(t) / len(t) * 1000)
+    overhead = min(times['hgbb']) - min(times['baseline'])
+    print 'hgbb overhead: %.1f ms' % (overhead * 1000)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
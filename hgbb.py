@@ -25,15 +25,66 @@ This extension has two purposes:
 - access bitbucket repositories via short URIs like ``bb:[name/]repo``
 - conveniently do several bitbucket.org operations on the command line
 
-The ``lxml`` module is required for operations that need to scrape pages
-from bitbucket.org (currently bbforks).
-
 Configuration::
 
     [bb]
     username = your bitbucket username
     password = your bitbucket http password for http (otherwise you'll be asked)
-    default_method = the default checkout method to use (ssh or http)
+    default_method = the default checkout method to use (ssh or http); with
+                     auto, the faster one is measured for every host
+    auto_method_ttl = seconds for which the choice of default_method = auto
+                      is remembered (default 86400)
+    url = base URL of bitbucket for http access, pages and links
+          (default https://bitbucket.org)
+    api_url = base URL of the bitbucket API
+              (default https://api.bitbucket.org/1.0)
+    fork_workers = number of forks to check at the same time in bbforks -i/-o
+                   (default 1)
+    ssh_multiplex = share one ssh connection between all bb+ssh peers of a
+                    command (OpenSSH only, default True)
+    clone_workers = number of repositories bbclone-many clones at the same
+                    time (default 4)
+    seed_repos = local repositories that clones of bb:// URLs start from when
+                 they have the same root changeset (comma-separated); only
+                 the remaining changesets are pulled from bitbucket
+    keep_bundles = keep the changesets found by bbforks -i for a later pull
+                   (default False)
+    bundle_cache_size = megabytes of such changesets to keep (default 100)
+    followers_cache_ttl = seconds for which bbfollowers trusts its cached list
+                          of followers (default 3600)
+    followers_page_size = followers asked for with every API request of
+                          bbfollowers (default 50)
+    metadata_cache_ttl = seconds for which bbforks trusts the cached update
+                         dates of forks (default 3600)
+    api_workers = number of pages of API results to fetch at the same time
+                  (default 4)
+    stream = ask for uncompressed streaming clones of bb:// URLs, which cost
+             less CPU on a fast network (default False)
+    bundle_store = local directory or http(s) URL with prebuilt bundles
+                   (``user/repo.hg``) that clones of bb:// URLs start from
+    rate_limit = requests per second sent to bitbucket on average (default
+                 0, no limit: requests only slow down when bitbucket asks)
+    rate_burst = requests that may be sent at once before rate_limit
+                 applies (default 10)
+    request_retries = how often a throttled or temporarily failed request
+                      is retried (default 4)
+    forks_cache_ttl = seconds for which bbforks trusts its cached fork list
+                      without asking bitbucket (default 0)
+    probe_heads = reuse the last bbforks -i/-o result for forks whose heads
+                  did not change (default True)
+    fork_mirror = keep the changesets of all forks in a local mirror for
+                  bbforks -i/-o (default False)
+    single_pass_outgoing = compute the outgoing changesets of all forks in
+                           one pass over the local history in bbforks -o
+                           (default False)
+    proxy = base URL of an hg bbproxy that bb:// URLs are reached through
+            over http (e.g. http://ci-cache:8000); default_method = auto
+            then picks http
+    proxy_cache_dir = where hg bbproxy keeps responses
+                      (default ~/.cache/hgbb/proxy)
+    proxy_cache_size = megabytes of responses hg bbproxy keeps (default 1024)
+    proxy_ttl = seconds for which hg bbproxy reuses heads, bookmarks and
+                other answers that change with the repository (default 30)
 
 There is one additional configuration value that makes sense only in
 repository-specific configuration files::
@@ -62,25 +113,140 @@ URL on the command line.  It will *not* work when put into the [paths]
 entry in hgrc.
 """
 
-try:
-    from mercurial.httprepo import instance as httprepo_instance
-    from mercurial.sshrepo import sshrepository as sshrepo_instance
-except ImportError: # for 2.3
-    from mercurial.httppeer import instance as httprepo_instance
-    from mercurial.sshpeer import instance as sshrepo_instance
+# This module is loaded by every hg command, most of which never talk to
+# bitbucket; everything that is not needed to register the commands and the
+# URL schemes is only imported where it is used.
 
-from mercurial import hg, url, commands, util, \
-     error, extensions
+from mercurial import hg, url, commands, cmdutil, util, error, extensions
+from mercurial.node import hex
 
 import os
-import base64
-import urllib
-import urllib2
-import urlparse
-import json
+import time
 
 # utility functions
 
+def httprepo_instance(ui, path, create):
+    try:
+        from mercurial.httprepo import instance
+    except ImportError: # for 2.3
+        from mercurial.httppeer import instance
+    return instance(ui, path, create)
+
+def sshrepo_instance(ui, path, create):
+    try:
+        from mercurial.sshrepo import sshrepository as instance
+    except ImportError: # for 2.3
+        from mercurial.sshpeer import instance
+    return instance(_sshmultiplex(ui), path, create)
+
+# directory of the ssh control sockets of this process, see _sshmultiplex
+_sshcontrol = {}
+
+def _sshmultiplex(ui):
+    """Return a copy of ``ui`` whose ssh command shares one master connection
+    per host for the rest of the hg command, or ``ui`` itself if that is
+    disabled or not supported by the ssh client."""
+    sshcmd = ui.config('ui', 'ssh', 'ssh')
+    if (not ui.configbool('bb', 'ssh_multiplex', True) or os.name == 'nt' or
+        'plink' in sshcmd.lower() or 'ControlPath' in sshcmd):
+        return ui
+    controldir = _sshcontrol.get('dir')
+    if controldir is None:
+        import tempfile
+        import atexit
+        newdir = tempfile.mkdtemp(prefix='hgbb-ssh-')
+        # setdefault is atomic: concurrent peers agree on one directory
+        controldir = _sshcontrol.setdefault('dir', newdir)
+        if controldir == newdir:
+            atexit.register(_sshcleanup, sshcmd, controldir)
+        else:
+            os.rmdir(newdir)
+    ui = ui.copy()
+    # the first connection to a host becomes the master and stays in the
+    # background until _sshcleanup; the others only open a new channel on it.
+    # Should the cleanup not run (hg killed), an idle master still exits
+    # after a minute.
+    ui.setconfig('ui', 'ssh', '%s -o ControlMaster=auto -o ControlPath=%s '
+                 '-o ControlPersist=60'
+                 % (sshcmd, util.shellquote(os.path.join(controldir,
+                                                         '%r@%h:%p'))))
+    return ui
+
+def _sshcleanup(sshcmd, controldir):
+    """Stop the ssh masters started by this process."""
+    import shutil
+    import subprocess
+    for name in os.listdir(controldir):
+        userhost, port = name.rsplit(':', 1)
+        cmd = '%s -o ControlPath=%s -O exit -p %s %s' % (
+            sshcmd, util.shellquote(os.path.join(controldir, name)), port,
+            util.shellquote(userhost))
+        null = open(os.devnull, 'w')
+        try:
+            subprocess.call(cmd, shell=True, stdout=null, stderr=null)
+        finally:
+            null.close()
+    shutil.rmtree(controldir, True)
+    _sshcontrol.pop('dir', None)
+
+def _loadjson(repo, filename):
+    """Return the data stored in ``filename`` under ``.hg``, or None."""
+    import json
+    try:
+        return json.loads(repo.opener(filename).read())
+    except (IOError, ValueError):
+        return None
+
+def _savejson(repo, filename, data):
+    import json
+    try:
+        fp = repo.opener(filename, 'w', atomictemp=True)
+        fp.write(json.dumps(data))
+        fp.close()
+    except IOError:
+        # these files are only caches
+        pass
+
+class usercache(object):
+    """JSON data kept in ``~/.cache/hgbb/<name>`` (under ``$XDG_CACHE_HOME``
+    if that is set), shared by all repositories."""
+
+    def __init__(self, name):
+        cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        self.filename = os.path.join(cachedir, 'hgbb', name)
+
+    def load(self):
+        import json
+        try:
+            fp = open(self.filename)
+            try:
+                return json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, data):
+        import json
+        try:
+            util.makedirs(os.path.dirname(self.filename))
+            fp = util.atomictempfile(self.filename)
+            fp.write(json.dumps(data))
+            fp.close()
+        except (IOError, OSError):
+            # only a cache
+            pass
+
+def get_bburl(ui):
+    """Return the base URL of the bitbucket web site."""
+    return (ui.config('bb', 'url', None) or 'https://bitbucket.org').rstrip('/')
+
+def get_apiurl(ui):
+    """Return the base URL of the bitbucket API."""
+    return (ui.config('bb', 'api_url', None) or
+            'https://api.bitbucket.org/1.0').rstrip('/')
+
 def get_username(ui):
     """Return the bitbucket username or guess from the login name."""
     username = ui.config('bb', 'username', None)
@@ -93,6 +259,7 @@ def get_username(ui):
 
 def parse_repopath(path):
     if '://' in path:
+        import urlparse
         parts = urlparse.urlsplit(path)
         # http or ssh full path
         if parts[1].endswith('bitbucket.org'):
@@ -120,6 +287,9 @@ def get_bbreponame(ui, repo, opts):
                 if reponame:
                     break
         else:
+            if repo is None:
+                raise util.Abort('no repository found, use -n to give the '
+                                 'name of the repo at bitbucket')
             # guess from repository pathname
             reponame = os.path.split(repo.root)[1]
         constructed = True
@@ -133,6 +303,673 @@ def get_bbreponame(ui, repo, opts):
     return reponame
 
 
+def _runconcurrently(func, items, workers):
+    """Call ``func(item)`` for every item, running up to ``workers`` calls at
+    the same time.
+
+    Yields ``(item, result, error)`` tuples in the order of ``items``.  An
+    exception raised by ``func`` is passed on as ``error`` instead of
+    stopping the remaining calls.
+    """
+    if workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception, e:
+                yield item, None, e
+        return
+
+    import threading
+    import Queue
+    import collections
+
+    _threadsaferevsets()
+    tasks = Queue.Queue()
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            item, done, result = task
+            try:
+                result.extend((func(item), None))
+            except Exception, e:
+                result.extend((None, e))
+            done.set()
+
+    threads = [threading.Thread(target=worker) for i in xrange(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    pending = collections.deque()
+    try:
+        for item in items:
+            task = (item, threading.Event(), [])
+            tasks.put(task)
+            pending.append(task)
+            while pending and pending[0][1].isSet():
+                item, done, result = pending.popleft()
+                yield (item,) + tuple(result)
+        while pending:
+            item, done, result = pending.popleft()
+            # wait with a timeout, or KeyboardInterrupt would not get through
+            while not done.isSet():
+                done.wait(0.1)
+            yield (item,) + tuple(result)
+    finally:
+        for thread in threads:
+            tasks.put(None)
+
+
+def _threadsaferevsets():
+    """Let concurrent workers parse revset queries.
+
+    Before Mercurial 3.0, all queries are parsed by one shared parser
+    object, which keeps the state of the parsing in itself, so the queries
+    of concurrent workers (e.g. the ones of push and discovery) would
+    garble each other.  With those versions, ``revset.parse`` is replaced
+    by a function that builds a fresh parser for every query; later
+    versions are left alone.
+    """
+    from mercurial import revset, parser
+    shared = getattr(revset.parse, 'im_self', None)
+    if not isinstance(shared, parser.parser):
+        return
+    def parse(spec, lookup=None):
+        return parser.parser(shared._tokenizer, shared._elements).parse(spec)
+    revset.parse = parse
+
+
+# http session shared by all requests to bitbucket
+
+class ratelimiter(object):
+    """Token bucket pacing requests to ``rate`` per second on average, with
+    bursts of up to ``burst`` requests; a ``rate`` of 0 does not limit.
+
+    ``pause`` stops all requests for a while, e.g. when the server asked to
+    slow down.
+    """
+
+    def __init__(self, rate, burst):
+        import threading
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.pauseuntil = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return 0, or return how long to wait for one."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if now < self.pauseuntil:
+                return self.pauseuntil - now
+            if self.rate <= 0:
+                return 0
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+        finally:
+            self._lock.release()
+
+    def pause(self, seconds):
+        self._lock.acquire()
+        try:
+            self.pauseuntil = max(self.pauseuntil, time.time() + seconds)
+        finally:
+            self._lock.release()
+
+
+class _inflight(object):
+    """A GET request in progress, whose response is shared with identical
+    requests made meanwhile."""
+
+    # larger responses (bundles) are not kept for sharing
+    maxsize = 1 << 20
+
+    def __init__(self):
+        import threading
+        self.done = threading.Event()
+        self.complete = False
+        self.chunks = []
+        self.size = 0
+
+    def add(self, data):
+        if self.chunks is not None:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size > self.maxsize:
+                self.chunks = None
+
+
+# statuses with which bitbucket asks to come back later
+RETRY_STATUSES = (429, 502, 503, 504)
+
+class bbsession(object):
+    """Keep-alive HTTP(S) connections to bitbucket, shared by the whole
+    process.
+
+    Connections are pooled per host and reused by later requests, responses
+    may be gzip-compressed, and the Basic auth header is only built (and the
+    password only asked for) once.
+
+    Requests are paced by a token bucket (``bb.rate_limit`` requests per
+    second, in bursts of ``bb.rate_burst``).  Throttled or temporarily
+    failed requests are retried up to ``bb.request_retries`` times, after
+    the delay given by ``Retry-After`` or an exponential backoff, during
+    which no other request is sent either.  A GET that is identical to one
+    still in progress waits for that one and shares its response.
+
+    Like Mercurial itself, the proxy given by ``http_proxy.host`` (or else
+    the ``http_proxy``/``https_proxy`` environment variables) is used,
+    except for the hosts in ``http_proxy.no`` and ``no_proxy``.
+    """
+
+    def __init__(self, ui=None):
+        import threading
+        self.ui = ui
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._authheader = None
+        self._limiter = None
+        self._inflight = {}
+        self._proxies = {}
+
+    def _config(self):
+        """Read the pacing settings, once there is a ui to read them from."""
+        if self._limiter is None:
+            rate, burst, retries = 0.0, 10, 4
+            if self.ui is not None:
+                rate = float(self.ui.config('bb', 'rate_limit', None) or rate)
+                burst = self.ui.configint('bb', 'rate_burst', burst)
+                retries = self.ui.configint('bb', 'request_retries', retries)
+            self.retries = retries
+            self._limiter = ratelimiter(rate, burst)
+        return self._limiter
+
+    def authheader(self, uri):
+        self._lock.acquire()
+        try:
+            if self._authheader is None:
+                import base64
+                username = get_username(self.ui)
+                password = self.ui.config('bb', 'password', None)
+                if password is not None:
+                    upw = '%s:%s' % (username, password)
+                else:
+                    # at least re-use Mercurial's password query
+                    passmgr = url.passwordmgr(self.ui)
+                    passmgr.add_password(None, uri, username, '')
+                    upw = '%s:%s' % passmgr.find_user_password(None, uri)
+                self._authheader = 'Basic %s' % base64.b64encode(upw).strip()
+            return self._authheader
+        finally:
+            self._lock.release()
+
+    def _proxy(self, key):
+        """Return ``(host, headers)`` of the proxy to reach ``key`` through,
+        or None to connect directly."""
+        if key in self._proxies:
+            return self._proxies[key]
+        import os
+        import urllib
+        import urlparse
+        scheme, host = key
+        proxy = user = passwd = None
+        noproxy = ['localhost', '127.0.0.1']
+        if self.ui is not None:
+            proxy = self.ui.config('http_proxy', 'host', None)
+            user = self.ui.config('http_proxy', 'user', None)
+            passwd = self.ui.config('http_proxy', 'passwd', None)
+            noproxy.extend([p.lower()
+                            for p in self.ui.configlist('http_proxy', 'no')])
+        if not proxy:
+            envproxies = urllib.getproxies()
+            proxy = envproxies.get(scheme) or envproxies.get('http')
+        noproxy.extend([p.strip().lower()
+                        for p in os.environ.get('no_proxy', '').split(',')
+                        if p.strip()])
+        result = None
+        if proxy and host.split(':')[0].lower() not in noproxy:
+            # the proxy can be a proper URL or just host[:port]
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            parts = urlparse.urlsplit(proxy)
+            user = parts.username or user
+            passwd = parts.password or passwd
+            headers = {}
+            if user:
+                import base64
+                upw = '%s:%s' % (urllib.unquote(user),
+                                 urllib.unquote(passwd or ''))
+                headers['Proxy-Authorization'] = (
+                    'Basic %s' % base64.b64encode(upw).strip())
+            result = parts[1].rsplit('@', 1)[-1], headers
+        self._proxies[key] = result
+        return result
+
+    def _getconn(self, key, reuse=True):
+        if reuse:
+            self._lock.acquire()
+            try:
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop(), True
+            finally:
+                self._lock.release()
+        import httplib
+        scheme, host = key
+        proxy = self._proxy(key)
+        if proxy is None:
+            if scheme == 'https':
+                return httplib.HTTPSConnection(host), False
+            return httplib.HTTPConnection(host), False
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(proxy[0])
+            conn.set_tunnel(host, headers=proxy[1])
+            return conn, False
+        return httplib.HTTPConnection(proxy[0]), False
+
+    def _release(self, key, conn):
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+    def request(self, uri, data=None, headers=None, auth=False):
+        """Send a GET (or, with ``data``, a POST) request for ``uri``.
+
+        The returned response must be read to the end or closed, so that
+        its connection can be used again (and identical requests waiting
+        for it can go on).
+        """
+        import urlparse
+        parts = urlparse.urlsplit(uri)
+        key = (parts[0], parts[1])
+        path = parts[2] or '/'
+        if parts[3]:
+            path += '?' + parts[3]
+        allheaders = {'Accept-Encoding': 'gzip',
+                      'User-Agent': 'mercurial/hgbb'}
+        if data is not None:
+            allheaders['Content-Type'] = 'application/x-www-form-urlencoded'
+        if auth:
+            event = _tracestart('auth', parts[1])
+            try:
+                allheaders['Authorization'] = self.authheader(uri)
+            finally:
+                _tracestop(event)
+        allheaders.update(headers or {})
+        if data is not None:
+            return self._send(key, path, data, allheaders)
+
+        ident = (uri, tuple(sorted(allheaders.items())))
+        self._lock.acquire()
+        try:
+            inflight = self._inflight.get(ident)
+            if inflight is None:
+                self._inflight[ident] = leader = _inflight()
+        finally:
+            self._lock.release()
+        if inflight is not None:
+            event = _tracestart('coalesced', uri)
+            try:
+                # with a timeout, or KeyboardInterrupt would not get through
+                while not inflight.done.isSet():
+                    inflight.done.wait(0.1)
+            finally:
+                _tracestop(event)
+            if inflight.complete:
+                return bufferedresponse(inflight)
+            # the other request failed or was not kept: do it ourselves
+            return self._send(key, path, data, allheaders)
+        try:
+            response = self._send(key, path, data, allheaders)
+        except:
+            self._finish(ident, leader)
+            raise
+        response._inflight = (ident, leader)
+        leader.status = response.status
+        leader.reason = response.reason
+        leader.msg = response.msg
+        return response
+
+    def _finish(self, ident, inflight, complete=False):
+        self._lock.acquire()
+        try:
+            self._inflight.pop(ident, None)
+        finally:
+            self._lock.release()
+        inflight.complete = complete and inflight.chunks is not None
+        inflight.done.set()
+
+    def _send(self, key, path, data, headers):
+        import httplib
+        import socket
+        limiter = self._config()
+        method = data is None and 'GET' or 'POST'
+        proxy = self._proxy(key)
+        if proxy is not None and key[0] == 'http':
+            # a plain HTTP proxy is asked for the whole URL
+            path = 'http://%s%s' % (key[1], path)
+            headers = dict(headers, **proxy[1])
+        attempt = 0
+        while True:
+            delay = limiter.reserve()
+            if delay:
+                event = _tracestart('throttle', key[1])
+                time.sleep(delay)
+                _tracestop(event)
+                continue
+            # a POST gets a fresh connection: it cannot be sent again after
+            # a failure, as it may have been carried out all the same
+            conn, reused = self._getconn(key, method == 'GET')
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+                _tracecount(roundtrips=1)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # the server may have dropped a kept-alive connection; that
+                # is worth another try with a fresh one
+                if reused and method == 'GET':
+                    continue
+                raise
+            response = bbresponse(self, key, conn, response)
+            # a POST is only repeated when it was certainly not carried out
+            retryable = (response.status == 429 or
+                         (method == 'GET' and
+                          response.status in RETRY_STATUSES))
+            if not retryable or attempt >= self.retries:
+                return response
+            delay = _retryafter(response.getheader('Retry-After'))
+            if delay is None:
+                delay = min(2 ** attempt, 60)
+            response.close()
+            attempt += 1
+            # everybody slows down, not only this request
+            limiter.pause(delay)
+
+
+def _retryafter(value):
+    """Return the seconds to wait given by a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        import email.utils
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+class bbresponse(object):
+    """A response of a bbsession request, transparently un-gzipped."""
+
+    # (key, _inflight) of identical requests waiting for this response
+    _inflight = None
+
+    def __init__(self, session, key, conn, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._decompress = None
+        if response.getheader('content-encoding', '') == 'gzip':
+            import zlib
+            self._decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            if size < 0:
+                chunk = self._response.read()
+            else:
+                chunk = self._response.read(max(size, 8192))
+            _tracecount(bytes=len(chunk))
+            if chunk and self._decompress:
+                chunk = self._decompress.decompress(chunk)
+            elif not chunk:
+                self._eof = True
+                if self._decompress:
+                    chunk = self._decompress.flush()
+                self._closeconn()
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if self._inflight is not None:
+            self._inflight[1].add(data)
+            if self._eof and not self._buffer:
+                self._session._finish(complete=True, *self._inflight)
+                self._inflight = None
+        return data
+
+    def close(self):
+        if self._inflight is not None:
+            # not read to the end: the waiting requests are on their own
+            self._session._finish(*self._inflight)
+            self._inflight = None
+        self._closeconn()
+
+    def _closeconn(self):
+        if self._conn is None:
+            return
+        if self._eof and not self._response.will_close:
+            self._session._release(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
+class bufferedresponse(object):
+    """The shared response of a request that was in progress already."""
+
+    def __init__(self, inflight):
+        self.status = inflight.status
+        self.reason = inflight.reason
+        self.msg = inflight.msg
+        self._data = ''.join(inflight.chunks)
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._data)
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+_session = None
+
+def getsession(ui=None):
+    """Return the process-wide bbsession."""
+    global _session
+    if _session is None:
+        _session = bbsession(ui)
+    elif _session.ui is None:
+        _session.ui = ui
+    return _session
+
+
+# instrumentation
+
+class bbtracer(object):
+    """Timed phases of a bb command.
+
+    Every phase records its wall time and, for requests made through the
+    bbsession, the bytes received and the number of round-trips; these are
+    also counted for all phases that enclose it in the same thread.  The
+    traffic of Mercurial peers is not measured: phases without any bbsession
+    request have None (shown as "-") for their bytes and round-trips.
+
+    A phase can be paused (e.g. while a generator waits for its consumer);
+    its duration is then the time it was running.
+    """
+
+    def __init__(self):
+        import threading
+        self.origin = time.time()
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, name, target=''):
+        import threading
+        now = time.time()
+        event = dict(name=name, target=target, start=now,
+                     duration=None, bytes=None, roundtrips=None,
+                     thread=threading.currentThread().getName(),
+                     _elapsed=0.0, _since=now)
+        self._stack().append(event)
+        return event
+
+    def pause(self, event):
+        if event.get('_since') is None:
+            return
+        event['_elapsed'] += time.time() - event['_since']
+        event['_since'] = None
+        stack = self._stack()
+        if event in stack:
+            stack.remove(event)
+
+    def resume(self, event):
+        if event['duration'] is None and event['_since'] is None:
+            event['_since'] = time.time()
+            self._stack().append(event)
+
+    def stop(self, event):
+        if event['duration'] is not None:
+            return
+        self.pause(event)
+        event['duration'] = event.pop('_elapsed')
+        del event['_since']
+        self._lock.acquire()
+        try:
+            self.events.append(event)
+        finally:
+            self._lock.release()
+
+    def count(self, bytes=0, roundtrips=0):
+        for event in self._stack():
+            event['bytes'] = (event['bytes'] or 0) + bytes
+            event['roundtrips'] = (event['roundtrips'] or 0) + roundtrips
+
+    def report(self, ui):
+        """Write a summary table of the phases, slowest first."""
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault((event['name'], event['target']),
+                                      [0, 0.0, 0.0, None, None])
+            total[0] += 1
+            total[1] += event['duration']
+            total[2] = max(total[2], event['duration'])
+            if event['bytes'] is not None:
+                total[3] = (total[3] or 0) + event['bytes']
+                total[4] = (total[4] or 0) + event['roundtrips']
+        ui.write('%-12s %-30s %5s %10s %10s %10s %6s\n' % (
+            'phase', 'target', 'count', 'total ms', 'max ms', 'bytes',
+            'trips'))
+        for (name, target), total in sorted(totals.iteritems(),
+                                            key=lambda item: -item[1][1]):
+            if total[3] is None:
+                total[3] = total[4] = '-'
+            ui.write('%-12s %-30s %5d %10.1f %10.1f %10s %6s\n' % (
+                name, target, total[0], total[1] * 1000, total[2] * 1000,
+                total[3], total[4]))
+
+    def dump(self, filename, command):
+        """Write all phases as JSON to ``filename``."""
+        import json
+        events = []
+        for event in sorted(self.events, key=lambda e: e['start']):
+            event = dict(event)
+            event['start'] -= self.origin
+            events.append(event)
+        fp = open(filename, 'w')
+        try:
+            json.dump(dict(command=command, start=self.origin, events=events),
+                      fp, indent=1)
+        finally:
+            fp.close()
+
+
+_tracer = None
+
+def _tracestart(name, target=''):
+    """Start a phase, if the running command is traced."""
+    if _tracer is not None:
+        return _tracer.start(name, target)
+
+def _tracestop(event):
+    if event is not None and _tracer is not None:
+        _tracer.stop(event)
+
+def _tracepause(event):
+    if event is not None and _tracer is not None:
+        _tracer.pause(event)
+
+def _traceresume(event):
+    if event is not None and _tracer is not None:
+        _tracer.resume(event)
+
+def _tracecount(bytes=0, roundtrips=0):
+    if _tracer is not None:
+        _tracer.count(bytes, roundtrips)
+
+def _traced(func):
+    """Let the command ``func`` be traced with --timings and --trace."""
+    def traced(ui, *args, **opts):
+        global _tracer
+        if not (opts.get('timings') or opts.get('trace')):
+            return func(ui, *args, **opts)
+        _tracer = bbtracer()
+        event = _tracer.start('command', func.__name__)
+        try:
+            return func(ui, *args, **opts)
+        finally:
+            tracer, _tracer = _tracer, None
+            tracer.stop(event)
+            if opts.get('timings'):
+                tracer.report(ui)
+            if opts.get('trace'):
+                tracer.dump(opts['trace'], func.__name__)
+    traced.__name__ = func.__name__
+    traced.__doc__ = func.__doc__
+    return traced
+
+traceopts = [
+    ('', 'timings', None, 'print the time spent in each phase'),
+    ('', 'trace', '', 'write the timed phases as JSON to FILE', 'FILE'),
+]
+
+
 # bb: schemes repository classes
 
 class bbrepo(object):
@@ -155,51 +992,544 @@ class bbrepo(object):
             auth = '%s:%s@' % (username, password)
         else:
             auth = username + '@'
+        import urlparse
+        base = get_bburl(ui)
+        proxy = ui.config('bb', 'proxy', None)
+        if proxy and self.factory is httprepo_instance:
+            # the proxy passes the requests on to bitbucket
+            base = proxy
+        parts = urlparse.urlsplit(base)
         formats = dict(
             path=path.rstrip('/') + '/',
-            auth=auth
+            auth=auth,
+            scheme=parts[0],
+            host=parts[1] + parts[2]
         )
-        return self.factory(ui, self.url % formats, create)
+        event = _tracestart('peer', path)
+        try:
+            return self.factory(ui, self.url % formats, create)
+        finally:
+            _tracestop(event)
 
 
 class auto_bbrepo(object):
     def instance(self, ui, url, create):
         method = ui.config('bb', 'default_method', 'https')
-        if method not in ('ssh', 'http', 'https'):
+        if method not in ('ssh', 'http', 'https', 'auto'):
             raise util.Abort('Invalid config value for bb.default_method: %s'
                              % method)
+        if method == 'auto' and ui.config('bb', 'proxy', None):
+            # going through the proxy is what makes http the faster one
+            method = 'https'
+        if method == 'auto':
+            return autotransport(ui).instance(ui, url, create)
         if method == 'http':
             method = 'https'
         return hg.schemes['bb+' + method].instance(ui, url, create)
 
 
-def list_forks(reponame):
-    try:
-        from lxml.html import parse
-    except ImportError:
-        raise util.Abort('lxml.html is (currently) needed to run bbforks')
+class autotransport(object):
+    """Pick the faster of ssh and https to reach bitbucket.
 
-    try:
-        tree = parse(urllib.urlopen('https://bitbucket.org/%s/descendants/' % reponame))
-    except IOError, e:
-        raise util.Abort('getting bitbucket page failed with:\n%s' % e)
+    Both are timed (connection setup, authentication and one round-trip to
+    get the heads) and the winner is remembered per host in
+    ``~/.cache/hgbb/transports`` for ``bb.auto_method_ttl`` seconds.
+    """
+
+    methods = ('https', 'ssh')
+
+    def __init__(self, ui):
+        import urlparse
+        self.host = urlparse.urlsplit(get_bburl(ui))[1]
+        self.ttl = ui.configint('bb', 'auto_method_ttl', 86400)
+        self.cache = usercache('transports')
+
+    def lookup(self):
+        """Return the remembered method for this host, or None."""
+        entry = self.cache.load().get(self.host)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['method']
+
+    def store(self, method, timings):
+        entries = self.cache.load()
+        entries[self.host] = dict(method=method, time=time.time(),
+                                  timings=timings)
+        self.cache.save(entries)
+
+    def instance(self, ui, url, create):
+        method = self.lookup()
+        if method is None and create:
+            # nothing to measure against a repository that does not exist
+            method = 'https'
+        if method is not None:
+            return hg.schemes['bb+' + method].instance(ui, url, create)
+
+        def probe(method):
+            event = _tracestart('probe', method)
+            start = time.time()
+            try:
+                peer = hg.schemes['bb+' + method].instance(ui, url, False)
+                peer.heads()
+            finally:
+                _tracestop(event)
+            return peer, time.time() - start
+        peers = {}
+        timings = {}
+        lasterr = None
+        for method, result, err in _runconcurrently(probe, self.methods, 2):
+            if err is not None:
+                ui.debug('%s to %s failed: %s\n' % (method, self.host, err))
+                lasterr = err
+                continue
+            peers[method], timings[method] = result
+        if not peers:
+            raise lasterr
+        best = min(timings, key=timings.get)
+        ui.note('using %s for %s (%s)\n' % (best, self.host, ', '.join(
+            '%s %.0f ms' % (m, timings[m] * 1000) for m in sorted(timings))))
+        self.store(best, timings)
+        for method, peer in peers.items():
+            if method != best:
+                peer.close()
+        # the peer of the winner is connected already: use it
+        return peers[best]
+
+
+class forkcache(object):
+    """Fork lists of bitbucket repositories, kept in ``.hg/bbforks.cache``.
+
+    Entries younger than ``ttl`` seconds are used as they are; older ones are
+    revalidated with the ETag/Last-Modified headers of the page they came
+    from.  With ``refresh`` set, the cached lists are never used directly.
+    """
+
+    filename = 'bbforks.cache'
+
+    def __init__(self, repo, ttl=0, refresh=False):
+        import threading
+        self.repo = repo
+        self.ttl = ttl
+        self.refresh = refresh
+        self.entries = _loadjson(repo, self.filename) or {}
+        # fork lists can be stored from several threads (bbforks --recursive)
+        self._lock = threading.Lock()
+
+    def lookup(self, reponame):
+        return self.entries.get(reponame)
+
+    def isfresh(self, entry):
+        return (not self.refresh and
+                time.time() - entry['time'] < self.ttl)
+
+    def store(self, reponame, forks, etag=None, modified=None):
+        self._lock.acquire()
+        try:
+            self.entries[reponame] = dict(forks=forks, etag=etag,
+                                          modified=modified, time=time.time())
+            _savejson(self.repo, self.filename, self.entries)
+        finally:
+            self._lock.release()
+
+
+class forksparser(object):
+    """Incremental scraper for the forks section of a descendants page.
+
+    Fork names are appended to ``forks`` as soon as their entry has been
+    fed; ``found`` is set when the section starts and ``done`` when it is
+    over, and ``nextpage`` holds the link to the next page of the listing,
+    if there is one.
+    """
+
+    def __init__(self):
+        import HTMLParser
+        self._parser = HTMLParser.HTMLParser()
+        self._parser.handle_starttag = self.handle_starttag
+        self._parser.handle_endtag = self.handle_endtag
+        self._parser.handle_data = self.handle_data
+        self.forks = []
+        self.nextpage = None
+        self.found = False
+        self.done = False
+        self._insection = False
+        self._heading = None
+        self._links = None
+        self._innext = False
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'h2':
+            # the forks are followed by another section (patch queues)
+            if self._insection:
+                self._insection = False
+                self.done = True
+            self._heading = ''
+        elif not self._insection:
+            return
+        elif tag == 'dd' and 'name' in classes:
+            self._links = []
+        elif tag == 'li' and 'next' in classes:
+            self._innext = True
+        elif tag == 'a':
+            if self._links is not None:
+                self._links.append(attrs.get('href'))
+            if attrs.get('rel') == 'next' or self._innext:
+                self.nextpage = attrs.get('href')
+
+    def handle_endtag(self, tag):
+        if tag == 'h2' and self._heading is not None:
+            if self._heading.strip() == 'Forks':
+                self.found = self._insection = True
+            self._heading = None
+        elif tag == 'dd' and self._links is not None:
+            # Item 0 is a link to the user profile and item 1 is the link to
+            # the forked repo.
+            if len(self._links) > 1 and self._links[1]:
+                import urlparse
+                self.forks.append(urlparse.urlsplit(self._links[1])[2][1:])
+            self._links = None
+        elif tag == 'li':
+            self._innext = False
+
+    def handle_data(self, data):
+        if self._heading is not None:
+            self._heading += data
+
+
+def iter_forks(reponame, cache=None, baseurl='https://bitbucket.org'):
+    """Yield the names of the forks of ``reponame`` while the descendants
+    pages are read, following the pagination of the listing."""
+    import httplib
+    import urlparse
+    from HTMLParser import HTMLParseError
+    entry = cache and cache.lookup(reponame)
+    if entry and cache.isfresh(entry):
+        for name in entry['forks']:
+            yield name
+        return
+
+    pageurl = '%s/%s/descendants/' % (baseurl, reponame)
+    seen = set()
+    forks = []
+    validators = (None, None)
+    while pageurl and pageurl not in seen:
+        seen.add(pageurl)
+        firstpage = len(seen) == 1
+        headers = {}
+        if entry and not cache.refresh and firstpage:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['modified']:
+                headers['If-Modified-Since'] = entry['modified']
+        event = _tracestart('list_forks', '%s page %d' % (reponame, len(seen)))
+        try:
+            response = getsession().request(pageurl, headers=headers)
+        except (IOError, httplib.HTTPException), e:
+            _tracestop(event)
+            raise util.Abort('getting bitbucket page failed with:\n%s' % e)
+        if response.status == 304 and entry and firstpage:
+            # not modified since we last looked
+            response.close()
+            _tracestop(event)
+            cache.store(reponame, entry['forks'], entry['etag'],
+                        entry['modified'])
+            for name in entry['forks']:
+                yield name
+            return
+        if response.status >= 400:
+            response.close()
+            _tracestop(event)
+            raise util.Abort('getting bitbucket page failed with:\n'
+                             'HTTP Error %d: %s'
+                             % (response.status, response.reason))
+        if firstpage:
+            validators = (response.getheader('ETag'),
+                          response.getheader('Last-Modified'))
+
+        parser = forksparser()
+        try:
+            while not parser.done:
+                try:
+                    chunk = response.read(8192)
+                except (IOError, httplib.HTTPException), e:
+                    raise util.Abort('getting bitbucket page failed with:\n%s'
+                                     % e)
+                if not chunk:
+                    break
+                try:
+                    parser.feed(chunk)
+                except HTMLParseError, e:
+                    raise util.Abort('scraping bitbucket page failed:\n'
+                                     + str(e))
+                names = parser.forks[:]
+                del parser.forks[:]
+                # the time spent by the consumer of the forks is not part of
+                # this phase
+                _tracepause(event)
+                for name in names:
+                    forks.append(name)
+                    yield name
+                _traceresume(event)
+        finally:
+            response.close()
+            _tracestop(event)
+        if not parser.found:
+            # not a listing we understand: better fail than find no forks
+            raise util.Abort('scraping bitbucket page failed:\n'
+                             'no forks section on %s' % pageurl)
+        pageurl = parser.nextpage and urlparse.urljoin(pageurl,
+                                                       parser.nextpage)
+
+    if cache:
+        cache.store(reponame, forks, *validators)
+
+
+def list_forks(reponame, cache=None, baseurl='https://bitbucket.org'):
+    return list(iter_forks(reponame, cache, baseurl))
+
+
+def iter_forktree(ui, reponame, cache=None, depth=None, ignore=()):
+    """Yield the names of the forks of ``reponame``, of their forks and so
+    on, breadth-first, down to ``depth`` levels (all of them if None).
+
+    Every repository is reported once, however many times it is found;
+    ignored forks are neither reported nor crawled.  The forks of one level
+    are listed ``bb.fork_workers`` at a time.
+    """
+    baseurl = get_bburl(ui)
+    workers = ui.configint('bb', 'fork_workers', 1)
+    seen = set([reponame])
+    level = []
+    # the direct forks are reported while their list is being read
+    for name in iter_forks(reponame, cache, baseurl):
+        if name not in seen and name not in ignore:
+            seen.add(name)
+            level.append(name)
+            yield name
+    current = 1
+    while level and (depth is None or current < depth):
+        def listone(name):
+            return list_forks(name, cache, baseurl)
+        nextlevel = []
+        for parent, forks, err in _runconcurrently(listone, level, workers):
+            if err is not None:
+                ui.warn('listing the forks of %s failed: %s\n'
+                        % (parent, err))
+                continue
+            for name in forks:
+                if name not in seen and name not in ignore:
+                    seen.add(name)
+                    nextlevel.append(name)
+                    yield name
+        level = nextlevel
+        current += 1
+
+
+class forkmirror(object):
+    """Local store of the changesets of all forks, in ``.hg/bbforks-cache``.
+
+    The store is a repository of its own into which the local repository and
+    every fork are pulled; since it keeps the changesets of earlier runs,
+    each pull only transfers what is new.  Incoming and outgoing changesets
+    are then computed locally from the heads recorded for each fork.
+
+    The store starts as a clone of the local repository, which shares its
+    files through hardlinks where the filesystem allows; only the
+    changesets of the forks take space of their own.
+    """
+
+    def __init__(self, ui, repo):
+        import threading
+        self.repo = repo
+        self._lock = threading.Lock()
+        path = repo.join('bbforks-cache')
+        sui = ui.copy()
+        sui.setconfig('ui', 'quiet', 'True')
+        if not os.path.isdir(path):
+            hg.clone(sui, {}, repo.root, path, update=False)
+        self.store = hg.repository(sui, path)
+        # the store has to know all local changesets, or they would show up
+        # as incoming
+        self.store.pull(hg.peer(repo, {}, repo.root))
+        # secret changesets are not pulled, and are not outgoing either
+        self.localheads = repo.filtered('served').heads()
+
+    def missing(self, ui, name, hgcmdname, other=None):
+        """Update the fork ``name`` in the store and return the nodes of its
+        incoming/outgoing changesets, and the repository they are in."""
+        if other is None:
+            other = hg.peer(ui, {}, 'bb://' + name)
+        heads = other.heads()
+        self._lock.acquire()
+        try:
+            self.store.pull(other, heads=heads)
+            if hgcmdname == 'incoming':
+                return (self.store.changelog.findmissing(self.localheads,
+                                                         heads),
+                        self.store)
+            return (self.store.changelog.findmissing(heads, self.localheads),
+                    self.repo)
+        finally:
+            self._lock.release()
+
+    def scan(self, ui, name, hgcmdname, templateopts, other=None):
+        """Update the fork ``name`` in the store and return the output of
+        incoming/outgoing for it."""
+        nodes, repo = self.missing(ui, name, hgcmdname, other)
+        self._lock.acquire()
+        try:
+            return _render_changesets(ui, repo, nodes, templateopts)
+        finally:
+            self._lock.release()
+
+
+class forkstate(object):
+    """Heads and scan results of every fork, kept in ``.hg/bbforks.state``.
+
+    A stored result is only valid for the fork heads and the local
+    repository state it was computed with.
+    """
+
+    filename = 'bbforks.state'
+
+    def __init__(self, repo):
+        import threading
+        self.repo = repo
+        self._lock = threading.Lock()
+        self.localkey = [hex(node) for node in repo.heads()] + [len(repo)]
+        self.entries = _loadjson(repo, self.filename) or {}
+
+    def lookup(self, name, key, heads):
+        entry = self.entries.get(name)
+        if (entry and entry['heads'] == sorted(map(hex, heads)) and
+            entry['local'] == self.localkey and key in entry['results']):
+            return entry['results'][key].encode('latin-1')
+
+    def store(self, name, key, heads, contents):
+        """Remember ``contents`` as the result ``key`` of the fork ``name``
+        at ``heads``; a result larger than STATE_KEEP is not kept."""
+        heads = sorted(map(hex, heads))
+        self._lock.acquire()
+        try:
+            entry = self.entries.get(name)
+            if (not entry or entry['heads'] != heads or
+                entry['local'] != self.localkey):
+                entry = self.entries[name] = dict(heads=heads, results={},
+                                                  local=self.localkey)
+            if len(contents) > STATE_KEEP:
+                entry['results'].pop(key, None)
+                return
+            # the output is not necessarily utf-8, but json wants unicode
+            entry['results'][key] = contents.decode('latin-1')
+        finally:
+            self._lock.release()
+
+    def save(self):
+        _savejson(self.repo, self.filename, self.entries)
+
+
+class bundlecache(object):
+    """Bundles of the changesets incoming from forks, kept in
+    ``.hg/bbforks-bundles`` so that pulling a fork later does not download
+    them again.
+
+    When the bundles take more than ``maxsize`` bytes, the least recently
+    stored ones are removed.
+    """
+
+    dirname = 'bbforks-bundles'
+
+    def __init__(self, repo, maxsize):
+        import threading
+        self.repo = repo
+        self.maxsize = maxsize
+        self.path = repo.join(self.dirname)
+        self._lock = threading.Lock()
+        self.entries = _loadjson(repo, self.dirname + '/index') or {}
+
+    def _filename(self, name):
+        import urllib
+        return os.path.join(self.path, urllib.quote(name, '') + '.hg')
+
+    def tempname(self, name):
+        """Return where a new bundle of ``name`` should be written to."""
+        util.makedirs(self.path)
+        return self._filename(name) + '.tmp'
+
+    def lookup(self, name):
+        """Return the file name of the bundle of ``name``, or None."""
+        filename = self._filename(name)
+        if name in self.entries and os.path.exists(filename):
+            return filename
+
+    def add(self, name, tempname):
+        """Keep the bundle written to ``tempname`` for ``name``; no bundle
+        there means that nothing is incoming from the fork any more."""
+        self._lock.acquire()
+        try:
+            if not os.path.exists(tempname):
+                self._remove(name)
+            else:
+                util.rename(tempname, self._filename(name))
+                self.entries[name] = dict(size=os.path.getsize(
+                    self._filename(name)), time=time.time())
+                self._evict()
+            _savejson(self.repo, self.dirname + '/index', self.entries)
+        finally:
+            self._lock.release()
+
+    def discard(self, name):
+        self._lock.acquire()
+        try:
+            self._remove(name)
+            _savejson(self.repo, self.dirname + '/index', self.entries)
+        finally:
+            self._lock.release()
 
+    def _remove(self, name):
+        self.entries.pop(name, None)
+        try:
+            os.unlink(self._filename(name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self.entries.itervalues())
+        byage = sorted(self.entries, key=lambda n: self.entries[n]['time'])
+        while total > self.maxsize and byage:
+            name = byage.pop(0)
+            total -= self.entries[name]['size']
+            self._remove(name)
+
+
+def _render_changesets(ui, repo, nodes, templateopts):
+    """Return the given changesets formatted like incoming/outgoing do."""
+    ui.pushbuffer()
     try:
-        # there are 2 ol for the listings, first is forks, second is mqs
-        descendants = tree.xpath('//h2[text()="Forks"]')[0].getnext()
-        if descendants.find('.[@class="detailed iterable"]') is None:
-            return []
-        forklist = descendants.findall('.//dd[@class="name"]')
-        # Item 0 is a link to the user profile and item 1 is the link to the
-        # forked repo.
-        urls = [a.findall("a")[1].attrib['href'] for a in forklist]
-        if not urls:
-            return []
-    except Exception, e:
-        raise util.Abort('scraping bitbucket page failed:\n' + str(e))
-
-    forks = [urlparse.urlsplit(url)[2][1:] for url in urls]
-    return forks
+        _show_changesets(ui, repo, nodes, templateopts)
+    finally:
+        contents = ui.popbuffer(True)
+    return contents
+
+def _show_changesets(ui, repo, nodes, templateopts):
+    """Write the given changesets to ``ui`` like incoming/outgoing do, the
+    newest first."""
+    displayer = cmdutil.show_changeset(ui, repo, templateopts)
+    revs = sorted((repo[node].rev() for node in nodes), reverse=True)
+    for rev in revs:
+        displayer.show(repo[rev])
+    displayer.close()
+
+def _foundstatus(ui, number, hgcmdname, name):
+    """Tell that ``number`` changesets were found in the fork ``name``; this
+    comes before the changesets themselves."""
+    if number:
+        ui.status('%d %s changeset%s found in bb://%s\n' %
+                  (number, hgcmdname, number > 1 and 's' or '', name),
+                  label='status.modified')
 
 
 # new commands
@@ -216,178 +1546,1572 @@ def bb_forks(ui, repo, **opts):
     With the ``-i`` option, check each fork for incoming changesets.  With the
     ``-i -f`` options, also show the individual incoming changesets like
     :hg:`incoming` does.
+
+    The fork list is cached in the repository for ``bb.forks_cache_ttl``
+    seconds; after that, it is only downloaded again if bitbucket reports a
+    change.  Use ``--refresh`` to always download it.
+
+    Set ``bb.fork_workers`` to check several forks at the same time; the
+    output is still reported fork by fork, in the order of the list.
+
+    The heads of every fork are remembered in ``.hg/bbforks.state``; a fork
+    whose heads did not change since the last run is reported from the
+    stored result without looking for changesets again.  Set
+    ``bb.probe_heads`` to false to disable this.
+
+    With ``--count``, only print the number of incoming and outgoing
+    changesets of every fork (or just the ones asked for with ``-i``/``-o``),
+    without formatting any changeset.  ``--json`` prints the same as one
+    JSON record per fork, with its heads and any error; combine it with
+    ``-q`` to get nothing else.
+
+    With ``--mirror`` (or ``bb.fork_mirror`` set), the changesets of all
+    forks are kept in ``.hg/bbforks-cache``, so that later runs only
+    download the changesets that are new since the previous one.
+
+    With ``--keep-bundles`` (or ``bb.keep_bundles`` set), the changesets
+    found by ``-i`` are kept in ``.hg/bbforks-bundles``, up to
+    ``bb.bundle_cache_size`` megabytes (100 by default).  A later
+    :hg:`pull` of a fork applies them first and only downloads the
+    changesets that are newer.
+
+    ``--active-since DATE`` (a date, or ``-N`` for N days ago) skips the
+    forks that were not updated since, and ``--limit N`` keeps only the N
+    most recently updated ones, before any of them is looked at.  The dates
+    come from the bitbucket API and are cached for
+    ``bb.metadata_cache_ttl`` seconds (one hour by default).
+
+    With ``--recursive``, the forks of the forks are included too, level by
+    level, down to ``--depth`` levels if given.  A repository found more
+    than once is only reported the first time.
+
+    With ``-o --single-pass`` (or ``bb.single_pass_outgoing`` set), the
+    heads of all forks are collected first, and the outgoing changesets of
+    every fork are then found in one walk over the local history instead of
+    one per fork.  Neither the stored results nor the mirror are used then.
     '''
 
     reponame = get_bbreponame(ui, repo, opts)
     ui.status('getting descendants list\n')
-    forks = list_forks(reponame)
-    if not forks:
-        ui.status('this repository has no forks yet\n')
-        return
-    # filter out ignored forks
+    # the pages are read through the session, which is configured by ui
+    getsession(ui)
+    cache = None
+    if repo is not None:
+        cache = forkcache(repo, ui.configint('bb', 'forks_cache_ttl', 0),
+                          opts.get('refresh'))
+    # filter out ignored forks; the list is consumed while it is still
+    # being downloaded, so that the first forks can be looked at early
     ignore = set(ui.configlist('bb', 'ignore_forks'))
-    forks = [name for name in forks if name not in ignore]
+    found = []
+    def iterforks():
+        if opts.get('recursive'):
+            names = iter_forktree(ui, reponame, cache,
+                                  opts.get('depth') or None, ignore)
+        else:
+            names = iter_forks(reponame, cache, get_bburl(ui))
+        for name in names:
+            found.append(name)
+            if name not in ignore:
+                yield name
+    forks = iterforks()
+    if opts.get('active_since') or opts.get('limit'):
+        forks = _activeforks(ui, list(forks), opts)
 
     hgcmd = None
     if opts.get('incoming'):
         hgcmd, hgcmdname = commands.incoming, "incoming"
     elif opts.get('outgoing'):
         hgcmd, hgcmdname = commands.outgoing, "outgoing"
-    if hgcmd:
+    if opts.get('count') or opts.get('json'):
+        _count_forks(ui, repo, forks, opts)
+    elif hgcmd is commands.outgoing and (
+        opts.get('single_pass') or
+        ui.configbool('bb', 'single_pass_outgoing')):
+        _outgoing_forks(ui, repo, forks, opts)
+    elif hgcmd:
         templateopts = {'template': opts.get('full') and FULL_TMPL or '\xff'}
-        for name in forks:
-            ui.status('looking at %s\n' % name)
+        workers = ui.configint('bb', 'fork_workers', 1)
+        mirror = _getmirror(ui, repo, opts)
+        state = _getstate(ui, repo)
+        bundles = None
+        if hgcmdname == 'incoming' and not mirror:
+            bundles = _getbundles(ui, repo, opts)
+        resultkey = hgcmdname + (opts.get('full') and '-full' or '')
+        # one fork at a time, the changesets can be written while they are
+        # found, instead of collecting the whole output of every fork first
+        streaming = workers <= 1 and not mirror
+        def scan(name):
+            event = _tracestart(hgcmdname, name)
             try:
-                ui.quiet = True
-                ui.pushbuffer()
+                return _scan(name)
+            finally:
+                _tracestop(event)
+        def _scan(name):
+            fui, frepo = _scanrepo(ui, repo, workers)
+            if streaming:
+                ui.status('looking at %s\n' % name)
+            # one peer for the heads and for the changesets
+            other = hg.peer(fui, {}, 'bb://' + name)
+            if state:
+                # a fork whose heads did not change since the last run gives
+                # the same result as back then
+                heads = other.heads()
+                contents = state.lookup(name, resultkey, heads)
+                # the changesets have to be downloaded again if they should
+                # be kept but are not
+                if contents is not None and not (
+                    bundles and '\xff' in contents and not bundles.lookup(name)):
+                    other.close()
+                    return contents.count('\xff'), contents, False
+            bundle = bundles and bundles.tempname(name) or ''
+            written = False
+            if mirror:
                 try:
-                    hgcmd(ui, repo, 'bb://' + name, bundle='',
-                          force=False, newest_first=True,
-                          **templateopts)
+                    contents = mirror.scan(fui, name, hgcmdname, templateopts,
+                                           other)
                 finally:
-                    ui.quiet = False
-                    contents = ui.popbuffer(True)
-            except (error.RepoError, util.Abort), msg:
-                ui.warn('Error: %s\n' % msg)
+                    other.close()
+                number = contents.count('\xff')
+            elif streaming:
+                number, contents = _stream_fork(fui, frepo, hgcmdname, name,
+                                                templateopts, bundle, other)
+                written = True
             else:
-                if not contents:
-                    continue
+                contents = _scan_fork(fui, frepo, hgcmdname, name,
+                                      templateopts, bundle, other)
                 number = contents.count('\xff')
-                if number:
-                    ui.status('%d %s changeset%s found in bb://%s\n' %
-                              (number, hgcmdname, number > 1 and 's' or '', name),
-                              label='status.modified')
+            if bundles:
+                bundles.add(name, bundle)
+            if state and contents is not None:
+                state.store(name, resultkey, heads, contents)
+            return number, contents, written
+        for name, result, err in _runconcurrently(scan, forks, workers):
+            if not streaming:
+                ui.status('looking at %s\n' % name)
+            if err is not None:
+                ui.warn('Error: %s\n' % err)
+                continue
+            number, contents, written = result
+            if not written:
+                _foundstatus(ui, number, hgcmdname, name)
+            if contents and not written:
                 ui.write(contents.replace('\xff', ''), label='log.changeset')
+        if state:
+            state.save()
     else:
         for name in forks:
             ui.status('bb://%s\n' % name)
-            #json = urllib.urlopen(
-            #    'http://api.bitbucket.org/1.0/repositories/%s/' % name).read()
+    if not found:
+        ui.status('this repository has no forks yet\n')
+
+def _parsesince(date):
+    """Return the timestamp of DATE, which may also be ``-N`` (N days ago)."""
+    if date.startswith('-') and date[1:].isdigit():
+        return time.time() - int(date[1:]) * 86400
+    return util.parsedate(date, util.extendeddateformats)[0]
+
+def _activeforks(ui, forks, opts):
+    """Return the forks updated since ``--active-since``; with ``--limit``,
+    only that many of the most recently updated ones, newest first."""
+    since = opts.get('active_since') and _parsesince(opts['active_since'])
+    metadata = fork_metadata(ui, forks, opts.get('refresh'))
+    active = []
+    for name in forks:
+        updated = metadata.get(name, {}).get('updated')
+        # a fork that cannot be dated is kept
+        if not since or updated is None or updated >= since:
+            active.append(name)
+    if opts.get('limit'):
+        active.sort(key=lambda name: -(metadata.get(name, {}).get('updated')
+                                       or 0))
+        del active[opts['limit']:]
+    ui.status('%d of %d forks selected by activity\n'
+              % (len(active), len(forks)))
+    return active
 
-def _bb_apicall(ui, endpoint, data, use_pass = True):
-    uri = 'https://api.bitbucket.org/1.0/%s/' % endpoint
+def _parseupdated(data):
+    """Return the last update in the metadata of a repository as timestamp."""
+    import calendar
+    value = data.get('utc_last_updated') or data.get('last_updated')
+    if not value:
+        return None
+    try:
+        parsed = time.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+    return calendar.timegm(parsed)
+
+def fork_metadata(ui, names, refresh=False):
+    """Return ``{name: dict(updated=timestamp, size=bytes)}`` for the
+    repositories ``names``, as far as the API knows them.
+
+    The metadata is fetched ``bb.api_workers`` at a time, and cached in
+    ``~/.cache/hgbb/metadata`` for ``bb.metadata_cache_ttl`` seconds.
+    """
+    import json
+    cache = usercache('metadata')
+    entries = cache.load()
+    ttl = ui.configint('bb', 'metadata_cache_ttl', 3600)
+    now = time.time()
+    result = {}
+    missing = []
+    for name in names:
+        entry = entries.get(name)
+        if entry and not refresh and now - entry['time'] < ttl:
+            result[name] = entry
+        else:
+            missing.append(name)
+    def fetch(name):
+        return json.loads(_bb_apicall(ui, 'repositories/%s' % name, None,
+                                      False))
+    workers = ui.configint('bb', 'api_workers', 4)
+    for name, data, err in _runconcurrently(fetch, missing, workers):
+        if err is not None:
+            ui.warn('cannot get the metadata of %s: %s\n' % (name, err))
+            continue
+        result[name] = entries[name] = dict(updated=_parseupdated(data),
+                                            size=data.get('size'), time=now)
+    if missing:
+        cache.save(entries)
+    return result
+
+def _getmirror(ui, repo, opts):
+    if opts.get('mirror') or ui.configbool('bb', 'fork_mirror'):
+        ui.status('updating local fork mirror\n')
+        return forkmirror(ui, repo)
+
+def _getbundles(ui, repo, opts):
+    if opts.get('keep_bundles') or ui.configbool('bb', 'keep_bundles'):
+        size = ui.configint('bb', 'bundle_cache_size', 100)
+        return bundlecache(repo, size << 20)
+
+def _getstate(ui, repo):
+    if repo is not None and ui.configbool('bb', 'probe_heads', True):
+        return forkstate(repo)
+
+def _scanrepo(ui, repo, workers):
+    """Return the ui and repository to look at one fork with."""
+    if workers <= 1:
+        return ui, repo
+    # every concurrent scan needs its own ui and repository, so that the
+    # output buffers of different forks do not get mixed up and status
+    # messages stay quiet
+    fui = ui.copy()
+    fui.setconfig('ui', 'quiet', 'True')
+    return fui, hg.repository(fui, repo.root)
+
+def _count_forks(ui, repo, forks, opts):
+    """Report the number of incoming and/or outgoing changesets of every
+    fork, as a line of text or a JSON record per fork.
+
+    The numbers come straight from discovery; no changeset is formatted.
+    """
+    import json
+    directions = [direction for direction in ('incoming', 'outgoing')
+                  if opts.get(direction)] or ['incoming', 'outgoing']
+    workers = ui.configint('bb', 'fork_workers', 1)
+    mirror = _getmirror(ui, repo, opts)
+    state = _getstate(ui, repo)
+    def count(name):
+        fui, frepo = _scanrepo(ui, repo, workers)
+        other = hg.peer(fui, {}, 'bb://' + name)
+        heads = other.heads()
+        record = dict(fork=name, heads=sorted(map(hex, heads)), error=None)
+        for direction in directions:
+            key = direction + '-count'
+            number = state and state.lookup(name, key, heads)
+            if number is None:
+                if mirror:
+                    number = len(mirror.missing(fui, name, direction,
+                                                other)[0])
+                else:
+                    number = _count_changesets(fui, frepo, direction, other)
+                if state:
+                    state.store(name, key, heads, str(number))
+            record[direction] = int(number)
+        return record
+    for name, record, err in _runconcurrently(count, forks, workers):
+        if err is not None:
+            record = dict(fork=name, heads=None, error=str(err))
+        if opts.get('json'):
+            ui.write(json.dumps(record, sort_keys=True) + '\n')
+        elif err is not None:
+            ui.warn('Error: bb://%s: %s\n' % (name, err))
+        else:
+            ui.write('bb://%s: %s\n' % (name, ', '.join(
+                '%d %s' % (record[direction], direction)
+                for direction in directions)))
+    if state:
+        state.save()
+
+def _count_changesets(ui, repo, direction, other):
+    """Return the number of changesets incoming from or outgoing to the peer
+    ``other``."""
+    from mercurial import bundlerepo, discovery
+    quiet, ui.quiet = ui.quiet, True
+    try:
+        if direction == 'outgoing':
+            return len(discovery.findcommonoutgoing(repo, other).missing)
+        # the changesets have to be fetched to be counted, but that is all
+        other, csets, cleanup = bundlerepo.getremotechanges(ui, repo, other)
+        try:
+            return len(csets)
+        finally:
+            cleanup()
+    finally:
+        ui.quiet = quiet
+
+def _outgoing_forks(ui, repo, forks, opts):
+    """Report the outgoing changesets of every fork like bbforks -o does,
+    walking the local history only once for all forks.
+
+    The changesets every fork has in common with the local repository are
+    found first, ``bb.fork_workers`` forks at a time; the output follows
+    once all of them are known.
+    """
+    templateopts = {'template': opts.get('full') and FULL_TMPL or '\xff'}
+    workers = ui.configint('bb', 'fork_workers', 1)
+    def common(name):
+        event = _tracestart('heads', name)
+        try:
+            fui, frepo = _scanrepo(ui, repo, workers)
+            other = hg.peer(fui, {}, 'bb://' + name)
+            return _commonheads(fui, frepo, other)
+        finally:
+            _tracestop(event)
+    results = list(_runconcurrently(common, forks, workers))
+    cl = repo.changelog
+    commons = [[cl.rev(node) for node in nodes]
+               for name, nodes, err in results if err is None]
+    event = _tracestart('outgoing', 'all forks')
+    try:
+        missing = iter(_missing_revs(repo, commons))
+    finally:
+        _tracestop(event)
+    for name, nodes, err in results:
+        ui.status('looking at %s\n' % name)
+        if err is not None:
+            ui.warn('Error: %s\n' % err)
+            continue
+        revs = missing.next()
+        if revs:
+            _foundstatus(ui, len(revs), 'outgoing', name)
+            contents = _render_changesets(ui, repo, map(cl.node, revs),
+                                          templateopts)
+            ui.write(contents.replace('\xff', ''), label='log.changeset')
+
+def _commonheads(ui, repo, other):
+    """Return the heads of the changesets the peer ``other`` has in common
+    with ``repo``."""
+    from mercurial import discovery
+    quiet, ui.quiet = ui.quiet, True
+    try:
+        return discovery.findcommonincoming(repo, other)[0]
+    finally:
+        ui.quiet = quiet
+
+def _missing_revs(repo, commons):
+    """Return, for each list of common heads (as revisions) in ``commons``,
+    the revisions of ``repo`` that are not among their ancestors, newest
+    first.  Secret and extinct changesets are left out, like outgoing does.
+
+    A bitmap per revision records which lists of heads it is an ancestor
+    of; one walk from the tip down passes them on to the parents.
+    """
+    cl = repo.changelog
+    parentrevs = cl.parentrevs
+    marks = [0] * len(cl)
+    for bit, revs in enumerate(commons):
+        for rev in revs:
+            if rev >= 0:
+                marks[rev] |= 1 << bit
+    everywhere = (1 << len(commons)) - 1
+    excluded = set(cl.filteredrevs)
+    excluded.update(repo.revs('secret() or extinct()'))
+    # the revisions some list of heads does not reach, with their bitmaps
+    partial = []
+    for rev in xrange(len(marks) - 1, -1, -1):
+        mark = marks[rev]
+        if mark:
+            p1, p2 = parentrevs(rev)
+            if p1 >= 0:
+                marks[p1] |= mark
+            if p2 >= 0:
+                marks[p2] |= mark
+        if mark != everywhere and rev not in excluded:
+            partial.append((rev, mark))
+    return [[rev for rev, reached in partial if not reached & (1 << bit)]
+            for bit in xrange(len(commons))]
+
+def _fork_changes(ui, repo, hgcmdname, other, bundle=''):
+    """Find the changesets incoming from or outgoing to the peer ``other``.
+
+    Returns the repository they are in, their nodes, and a function to call
+    once they are no longer needed, which also closes ``other``.  Incoming
+    changesets are written to the file ``bundle``, if given.
+    """
+    from mercurial import bundlerepo, discovery
+    quiet = ui.quiet, repo.ui.quiet
+    ui.quiet = repo.ui.quiet = True
+    try:
+        if hgcmdname == 'incoming':
+            return bundlerepo.getremotechanges(ui, repo, other,
+                                               bundlename=bundle or None)
+        outgoing = discovery.findcommonoutgoing(repo, other)
+        return repo, outgoing.missing, other.close
+    except:
+        other.close()
+        raise
+    finally:
+        ui.quiet, repo.ui.quiet = quiet
+
+def _scan_fork(ui, repo, hgcmdname, name, templateopts, bundle='',
+               other=None):
+    """Look for the incoming/outgoing changesets of the fork ``name`` and
+    return their output.
+
+    The peer ``other`` of the fork is used (and closed) if given.  Incoming
+    changesets are written to the file ``bundle``, if given.
+    """
+    if other is None:
+        other = hg.peer(ui, {}, 'bb://' + name)
+    chrepo, nodes, cleanup = _fork_changes(ui, repo, hgcmdname, other, bundle)
+    try:
+        return _render_changesets(ui, chrepo, nodes, templateopts)
+    finally:
+        cleanup()
+
+# output of a fork that is kept for bbforks.state at most
+STATE_KEEP = 1 << 16
+
+def _stream_fork(ui, repo, hgcmdname, name, templateopts, bundle='',
+                 other=None):
+    """Look for the incoming/outgoing changesets of the fork ``name``,
+    writing them to ``ui`` as they are formatted.
+
+    Returns the number of changesets and their output, if it was small enough
+    to be kept (None otherwise).  The peer ``other`` of the fork is used (and
+    closed) if given.  Incoming changesets are written to the file
+    ``bundle``, if given.
+    """
+    if other is None:
+        other = hg.peer(ui, {}, 'bb://' + name)
+    chrepo, nodes, cleanup = _fork_changes(ui, repo, hgcmdname, other, bundle)
+    sui = _countingui(ui, STATE_KEEP)
+    try:
+        _foundstatus(ui, len(nodes), hgcmdname, name)
+        _show_changesets(sui, chrepo, nodes, templateopts)
+    finally:
+        cleanup()
+    if sui.kept is None:
+        return sui.changesets, None
+    return sui.changesets, ''.join(sui.kept)
+
+_countinguis = {}
+
+def _countingui(ui, keep):
+    """Return a copy of ``ui`` whose output is counted and passed straight
+    on to ``ui``.
+
+    ``changesets`` counts the changeset markers (``\\xff``) written, which
+    are removed from the output; the first ``keep`` bytes of the output are
+    collected in the list ``kept``, which becomes None when it grows larger.
+    """
+    cls = _countinguis.get(ui.__class__)
+    if cls is None:
+        class countingui(ui.__class__):
+            def write(self, *args, **opts):
+                if self._buffers:
+                    return super(countingui, self).write(*args, **opts)
+                for arg in args:
+                    arg = str(arg)
+                    self.changesets += arg.count('\xff')
+                    if self.kept is not None:
+                        self.keptsize += len(arg)
+                        if self.keptsize > self.keep:
+                            self.kept = None
+                        else:
+                            self.kept.append(arg)
+                    self.target.write(arg.replace('\xff', ''),
+                                      label='log.changeset')
+        cls = _countinguis[ui.__class__] = countingui
+    sui = cls(ui)
+    sui.target = ui
+    sui.changesets = 0
+    sui.keep = keep
+    sui.keptsize = 0
+    sui.kept = []
+    return sui
+
+def _bb_apicall(ui, endpoint, data, use_pass = True, query=None):
+    import urllib
+    import urllib2
+    uri = '%s/%s/' % (get_apiurl(ui), endpoint)
+    if query:
+        uri += '?' + urllib.urlencode(sorted(query.items()))
     # since bitbucket doesn't return the required WWW-Authenticate header when
     # making a request without Authorization, we cannot use the standard urllib2
     # auth handlers; we have to add the requisite header from the start
     if data is not None:
         data = urllib.urlencode(data)
-    req = urllib2.Request(uri, data)
     #ui.status("Accessing %s" % uri)
-    if use_pass:
-        # at least re-use Mercurial's password query
-        passmgr = url.passwordmgr(ui)
-        passmgr.add_password(None, uri, get_username(ui), '')
-        upw = '%s:%s' % passmgr.find_user_password(None, uri)
-        req.add_header('Authorization', 'Basic %s' % base64.b64encode(upw).strip())
-    return urllib2.urlopen(req).read()
+    event = _tracestart('apicall', endpoint)
+    try:
+        response = getsession(ui).request(uri, data, auth=use_pass)
+        body = response.read()
+    finally:
+        _tracestop(event)
+    if response.status >= 400:
+        raise urllib2.HTTPError(uri, response.status, response.reason,
+                                response.msg, None)
+    return body
 
-def bb_create(ui, reponame, **opts):
-    """Create repository on bitbucket"""
+def _createdata(reponame, opts):
     data = {
         'name': reponame,
         'description': opts.get('description'),
-        'language': opts.get('language').lower(),
+        'language': (opts.get('language') or '').lower(),
         'website': opts.get('website'),
         'scm': 'hg',
     }
     if opts.get('private'):
         data['is_private'] = True
+    return data
+
+def bb_create(ui, reponame=None, **opts):
+    """Create repository on bitbucket
 
-    _bb_apicall(ui, 'repositories', data)
+    With ``--batch FILE``, create a repository for every local repository
+    listed in FILE and push it there.  Every line gives the path of a local
+    repository, optionally followed by ``key=value`` settings (``name``,
+    default the directory name, ``description``, ``language``, ``website``
+    and ``private``), which override the ones given on the command line.
+    Up to ``--jobs`` repositories (default ``bb.clone_workers``, or 4) are
+    handled at the same time.
+    """
+    if opts.get('batch'):
+        return _create_batch(ui, opts['batch'], opts)
+    if not reponame:
+        raise util.Abort('no repository name given')
+    _bb_apicall(ui, 'repositories', _createdata(reponame, opts))
     # if this completes without exception, assume the request was successful,
     # and clone the new repo
     if opts['noclone']:
         ui.write('repository created\n')
     else:
         ui.write('repository created, cloning...\n')
-        commands.clone(ui, 'bb://' + reponame)
+        commands.clone(ui, 'bb://' + reponame, reponame)
+
+def _read_batch(fp, opts):
+    """Return ``(path, settings)`` for every line of a bbcreate batch file."""
+    jobs = []
+    names = set()
+    for line in fp:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        settings = dict(opts)
+        settings['name'] = os.path.basename(os.path.abspath(parts[0]))
+        for part in parts[1:]:
+            if '=' not in part:
+                raise util.Abort('invalid setting %r for %s' % (part, parts[0]))
+            key, value = part.split('=', 1)
+            if key == 'private':
+                value = value.lower() in ('1', 'yes', 'true', 'on')
+            settings[key] = value
+        if settings['name'] in names:
+            raise util.Abort('repository name %s is used twice'
+                             % settings['name'])
+        names.add(settings['name'])
+        jobs.append((parts[0], settings))
+    return jobs
+
+def _create_batch(ui, filename, opts):
+    fp = filename == '-' and ui.fin or open(filename)
+    try:
+        jobs = _read_batch(fp, dict(description=opts.get('description'),
+                                    language=opts.get('language'),
+                                    website=opts.get('website'),
+                                    private=opts.get('private')))
+    finally:
+        if fp is not ui.fin:
+            fp.close()
+    if not jobs:
+        ui.status('nothing to create\n')
+        return
+
+    _resolve_auth(ui)
+    workers = opts.get('jobs') or ui.configint('bb', 'clone_workers', 4)
+
+    def createone(job):
+        path, settings = job
+        pui = ui.copy()
+        pui.setconfig('ui', 'quiet', 'True')
+        # fail early, before creating anything, on a bad path
+        repo = hg.repository(pui, path)
+        start = time.time()
+        _bb_apicall(pui, 'repositories', _createdata(settings['name'],
+                                                     settings))
+        created = time.time()
+        # straight into the new (empty) repository, instead of cloning it
+        # and pulling the changesets into the clone
+        event = _tracestart('push', settings['name'])
+        try:
+            other = hg.peer(pui, {}, 'bb://' + settings['name'])
+            repo.push(other, newbranch=True)
+        finally:
+            _tracestop(event)
+        return created - start, time.time() - created, len(repo)
+
+    start = time.time()
+    done = failed = 0
+    for (path, settings), result, err in _runconcurrently(createone, jobs,
+                                                         workers):
+        if err is not None:
+            failed += 1
+            ui.warn('[%d/%d] %s failed: %s\n' % (done + failed, len(jobs),
+                                                  path, err))
+            continue
+        done += 1
+        createtime, pushtime, changesets = result
+        ui.status('[%d/%d] %s -> bb://%s (created in %.1f s, %d changesets '
+                  'pushed in %.1f s)\n'
+                  % (done + failed, len(jobs), path, settings['name'],
+                     createtime, changesets, pushtime))
+    ui.status('created %d of %d repositories in %.1f s\n'
+              % (done, len(jobs), time.time() - start))
+    if failed:
+        return 1
+
+def iter_followers(ui, reponame, refresh=False):
+    """Yield the followers of ``reponame`` (as given by the API) while their
+    pages are fetched, ``bb.api_workers`` at a time.
+
+    The list is cached in ``~/.cache/hgbb/followers`` for
+    ``bb.followers_cache_ttl`` seconds, unless ``refresh`` is set.
+    """
+    import json
+    cache = usercache('followers')
+    entry = cache.load().get(reponame)
+    ttl = ui.configint('bb', 'followers_cache_ttl', 3600)
+    if entry and not refresh and time.time() - entry['time'] < ttl:
+        for follower in entry['followers']:
+            yield follower
+        return
+
+    endpoint = 'repositories/%s/followers' % reponame
+    pagesize = ui.configint('bb', 'followers_page_size', 50)
+    def fetch(start):
+        return json.loads(_bb_apicall(ui, endpoint, None, False,
+                                      dict(start=start, limit=pagesize)))
+    first = fetch(0)
+    followers = first.get(u'followers', [])
+    for follower in followers:
+        yield follower
+    if followers:
+        # the remaining pages can all be asked for at once; bitbucket may
+        # give fewer followers per page than asked for
+        starts = xrange(len(followers), first.get(u'count', 0),
+                        len(followers))
+        workers = ui.configint('bb', 'api_workers', 4)
+        for start, page, err in _runconcurrently(fetch, starts, workers):
+            if err is not None:
+                raise err
+            for follower in page.get(u'followers', []):
+                followers.append(follower)
+                yield follower
+
+    entries = cache.load()
+    entries[reponame] = dict(followers=followers, time=time.time())
+    cache.save(entries)
 
 def bb_followers(ui, repo, **opts):
     '''list all followers of this repo at bitbucket
 
     An explicit bitbucket reponame (``username/repo``) can be given with the
     ``-n`` option.
+
+    The followers are printed while their pages are downloaded, in the
+    order bitbucket gives them.  ``--json`` prints one JSON record per
+    follower instead.  The list is cached for ``bb.followers_cache_ttl``
+    seconds (one hour by default); use ``--refresh`` to ignore the cache.
     '''
+    import json
     reponame = get_bbreponame(ui, repo, opts)
     ui.status('getting followers list\n')
-    retval = _bb_apicall(ui, 'repositories/%s/followers' % (reponame),
-                         None, False)
-    followers = json.loads(retval)
-    ui.write("List of followers:\n")
     encode = lambda t: t.encode('utf-8') if isinstance(t, unicode) else t
-    for follower in sorted(followers.get(u'followers', [])):
+    header = not opts.get('json')
+    for follower in iter_followers(ui, reponame, opts.get('refresh')):
+        if opts.get('json'):
+            ui.write(json.dumps(follower, sort_keys=True) + '\n')
+            continue
+        if header:
+            ui.write("List of followers:\n")
+            header = False
         ui.write("    %s (%s %s)\n" % tuple(map(encode, (
             follower['username'],
             follower['first_name'],
             follower['last_name']))))
+    if header:
+        ui.write("List of followers:\n")
+
+class linkresolver(object):
+    """Builds bitbucket links to the files of a repository.
+
+    The repository name and the working directory parent are looked up once
+    and only again when ``.hg/hgrc`` or ``.hg/dirstate`` change, which makes
+    many links in a row (``bblink --stdin``, or repeated bblink calls in a
+    command server) cheap.
+    """
+
+    def __init__(self, repo, opts):
+        self.repo = repo
+        self.opts = opts
+        self._hgrc = self._dirstate = False
+        self.reponame = self.nodeid = None
+
+    def _stamp(self, name):
+        try:
+            st = os.stat(self.repo.join(name))
+        except OSError:
+            return None
+        # files in .hg are replaced by renaming, so the inode changes too
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def refresh(self, ui):
+        stamp = self._stamp('hgrc')
+        if stamp != self._hgrc:
+            if self._hgrc is not False:
+                ui = self.repo.baseui.copy()
+                ui.readconfig(self.repo.join('hgrc'), self.repo.root)
+            self.ui = ui
+            self.reponame = get_bbreponame(ui, self.repo, self.opts)
+            self._hgrc = stamp
+        stamp = self._stamp('dirstate')
+        if stamp != self._dirstate:
+            from mercurial.node import short
+            self.repo.dirstate.invalidate()
+            # a dirty working copy gets the link of its parent, so there is
+            # no need to look at its status
+            self.nodeid = short(self.repo.dirstate.p1())
+            self._dirstate = stamp
+
+    def link(self, filename=None, lineno=-1):
+        # XXX: might not work on windows, because it uses \ to separate paths
+        if filename:
+            path = os.path.relpath(filename, self.repo.root)
+        else:
+            path = ''
+        url = '%s/%s/src/%s/%s'
+        url = url % (get_bburl(self.ui), self.reponame, self.nodeid, path)
+        if lineno != -1:
+            url += '#cl-' + str(lineno)
+        return url
+
+
+_linkresolvers = {}
 
 def bb_link(ui, repo, filename=None, **opts):
-    '''display a bitbucket link to the repository, or the specific file if given'''
-    # XXX: might not work on windows, because it uses \ to separate paths
-    lineno = opts.get('lineno')
-    reponame = get_bbreponame(ui, repo, opts)
-    nodeid = str(repo[None])
-    if nodeid.endswith('+'):
-        # our wc is dirty, just take the node id and be happy
-        nodeid = nodeid[:-1]
-    if filename:
-        path = os.path.relpath(filename, repo.root)
-    else:
-        path = ''
-    url = 'http://bitbucket.org/%s/src/%s/%s'
-    url = url % (reponame, nodeid, path)
-    if lineno != -1:
-        url += '#cl-' + str(lineno)
-    ui.write(url + '\n')
+    '''display a bitbucket link to the repository, or the specific file if given
 
-def clone(orig, ui, source, dest=None, **opts):
+    With ``--stdin``, read one ``FILE[:LINENO]`` per line from standard input
+    and write a link for each one, until the end of the input; an empty line
+    gives the link to the repository.  The repository name and working
+    directory parent are only looked up again when the hgrc or dirstate of
+    the repository change, also across calls in a command server.
+    '''
+    key = (repo.root, opts.get('reponame'))
+    resolver = _linkresolvers.get(key)
+    if resolver is None or resolver.repo is not repo:
+        resolver = _linkresolvers[key] = linkresolver(repo, opts)
+    if not opts.get('stdin'):
+        resolver.refresh(ui)
+        ui.write(resolver.link(filename, opts.get('lineno')) + '\n')
+        return
+    while True:
+        line = ui.fin.readline()
+        if not line:
+            break
+        filename, lineno = line.rstrip('\r\n'), -1
+        if ':' in filename:
+            head, tail = filename.rsplit(':', 1)
+            if tail.isdigit():
+                filename, lineno = head, int(tail)
+        resolver.refresh(ui)
+        ui.write(resolver.link(filename, lineno) + '\n')
+        ui.flush()
+
+def normalize_bburl(source):
+    """Turn the command line form ``bb:user/repo`` into ``bb://user/repo``."""
     if source[:2] == 'bb' and ':' in source:
         protocol, rest = source.split(':', 1)
         if rest[:2] != '//':
             source = '%s://%s' % (protocol, rest)
+    return source
+
+def _resolve_auth(ui):
+    """Settle username and http password in ``ui`` once, so that the peers
+    created from it (in any thread) do not ask again."""
+    username = get_username(ui)
+    ui.setconfig('bb', 'username', username)
+    method = ui.config('bb', 'default_method', 'https')
+    if method != 'ssh' and ui.config('bb', 'password', None) is None:
+        passmgr = url.passwordmgr(ui)
+        passmgr.add_password(None, get_bburl(ui), username, '')
+        password = passmgr.find_user_password(None, get_bburl(ui))[1]
+        ui.setconfig('bb', 'password', password)
+
+def _store_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.join(path, '.hg')):
+        for name in filenames:
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return size
+
+def _findseed(ui, other, candidates):
+    """Return the first local repository in ``candidates`` with the same
+    root changeset as the peer ``other``, or None."""
+    try:
+        root = other.lookup('0')
+    except error.RepoError:
+        # an empty repository has nothing to share
+        return None
+    for path in candidates:
+        try:
+            repo = hg.repository(ui, util.expandpath(path))
+        except error.RepoError:
+            continue
+        if len(repo) and repo[0].node() == root:
+            return repo
+    return None
+
+def _seededclone(ui, source, dest, seeds, update=True):
+    """Clone ``source`` into ``dest`` starting from a related local repository
+    among ``seeds``; only the changesets missing locally are pulled.
+
+    Return False (without doing anything) if none of them is related or the
+    copy of it fails.
+    """
+    import shutil
+    from mercurial import discovery
+    other = hg.peer(ui, {}, source)
+    seed = _findseed(ui, other, seeds)
+    if seed is None:
+        return False
+    ui.status('seeding %s from %s\n' % (dest, seed.root))
+    outgoing = discovery.findcommonoutgoing(seed, other)
+    if outgoing.missing:
+        # the seed has changesets of its own which do not belong in the
+        # clone: copy only what the fork has too (still without network)
+        rev = [hex(n) for n in outgoing.commonheads]
+    else:
+        # a hardlinked copy of the whole store
+        rev = None
+    try:
+        destrepo = hg.clone(ui, {}, seed.root, dest, rev=rev, update=False)[1]
+    except (util.Abort, error.RepoError, error.RevlogError, IOError), e:
+        # hg.clone removes what it created itself
+        ui.warn('cannot seed from %s: %s\n' % (seed.root, e))
+        return False
+    try:
+        _finishclone(destrepo.local(), source, other, update)
+    except:
+        # nothing that is in the way of another try
+        shutil.rmtree(dest, True)
+        raise
+    return True
+
+def _prefetchclone(ui, source, dest, store, update=True):
+    """Clone ``source`` into ``dest`` starting from the prebuilt bundle of
+    the repository in ``store`` (a local directory or an http(s) URL, where
+    the bundle of ``user/repo`` is ``user/repo.hg``); only the changesets
+    that are newer than the bundle are pulled.
+
+    Return False (without doing anything) if the store has no usable bundle
+    of it.
+    """
+    import httplib
+    import shutil
+    reponame = parse_repopath(source)
+    if '/' not in reponame:
+        reponame = '%s/%s' % (get_username(ui), reponame)
+    if '://' in store:
+        location = '%s/%s.hg' % (store.rstrip('/'), reponame)
+        event = _tracestart('prefetch', reponame)
+        try:
+            response = getsession(ui).request(location)
+        except (IOError, httplib.HTTPException), e:
+            _tracestop(event)
+            ui.warn('cannot get %s: %s\n' % (location, e))
+            return False
+        if response.status >= 400:
+            response.close()
+            _tracestop(event)
+            if response.status != 404:
+                ui.warn('cannot get %s: HTTP Error %d: %s\n'
+                        % (location, response.status, response.reason))
+            return False
+    else:
+        location = os.path.join(util.expandpath(store), reponame + '.hg')
+        if not os.path.isfile(location):
+            return False
+        response = event = None
+
+    ui.status('prefetching %s\n' % location)
+    destrepo = hg.repository(ui, dest, create=True)
+    try:
+        try:
+            _applyprefetched(destrepo, location, response, event)
+        except Exception, e:
+            # a broken bundle is not worth failing the clone for
+            ui.warn('cannot use %s: %s\n' % (location, e))
+            shutil.rmtree(dest, True)
+            return False
+        _finishclone(destrepo, source, hg.peer(ui, {}, source), update)
+    except:
+        # nothing that is in the way of another try
+        shutil.rmtree(dest, True)
+        raise
+    return True
+
+def _applyprefetched(destrepo, location, response, event):
+    """Add the changesets of the bundle at ``location`` (or, if given, of
+    its HTTP ``response``) to ``destrepo``."""
+    if response is not None:
+        # downloaded into the new repository, and applied from there
+        filename = destrepo.join('prefetch.hg')
+        fp = open(filename, 'wb')
+        try:
+            while True:
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+                fp.write(chunk)
+        finally:
+            fp.close()
+            response.close()
+            _tracestop(event)
+    else:
+        filename = location
+    try:
+        _applybundle(destrepo, filename)
+    finally:
+        if response is not None:
+            os.unlink(filename)
+
+def _finishclone(destrepo, source, other, update):
+    """Point ``destrepo`` at ``source``, pull what it still lacks from the
+    peer ``other`` and update the working directory if ``update`` is set."""
+    fp = destrepo.opener('hgrc', 'w', text=True)
+    fp.write('[paths]\ndefault = %s\n' % source)
+    fp.close()
+    destrepo.ui.setconfig('paths', 'default', source)
+    destrepo.pull(other)
+    if update:
+        try:
+            uprev = destrepo.lookup('default')
+        except error.RepoLookupError:
+            uprev = destrepo.lookup('tip')
+        hg.update(destrepo, uprev)
+
+def _fastclone(ui, source, dest, seeds, update=True):
+    """Clone ``source`` from a related local repository or a prebuilt
+    bundle, if possible; return False if neither can be used."""
+    if seeds and _seededclone(ui, source, dest, seeds, update):
+        return True
+    store = ui.config('bb', 'bundle_store', None)
+    return bool(store) and _prefetchclone(ui, source, dest, store, update)
+
+def bb_clone_many(ui, manifest, **opts):
+    '''clone many bitbucket repositories listed in a manifest file
+
+    Every line of MANIFEST gives a repository (``bb://user/repo``,
+    ``bb:user/repo`` or just ``user/repo``), optionally followed by the
+    destination directory; empty lines and lines starting with ``#`` are
+    ignored.  Up to ``--jobs`` repositories (default ``bb.clone_workers``, or
+    4) are cloned at the same time, failed clones are retried, and a summary
+    of the transfer is printed at the end.
+    '''
+    jobs = []
+    fp = manifest == '-' and ui.fin or open(manifest)
+    try:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            source = parts[0]
+            if ':' not in source:
+                source = 'bb://' + source
+            source = normalize_bburl(source)
+            if len(parts) > 1:
+                dest = parts[1]
+            else:
+                dest = source.rstrip('/').split('/')[-1]
+            jobs.append((source, dest))
+    finally:
+        if fp is not ui.fin:
+            fp.close()
+    if not jobs:
+        ui.status('nothing to clone\n')
+        return
+
+    _resolve_auth(ui)
+    workers = opts.get('jobs') or ui.configint('bb', 'clone_workers', 4)
+    retries = opts.get('retries') or 0
+    seeds = ui.configlist('bb', 'seed_repos')
+
+    def cloneone(job):
+        source, dest = job
+        cui = ui.copy()
+        cui.setconfig('ui', 'quiet', 'True')
+        event = _tracestart('clone', source)
+        start = time.time()
+        try:
+            for attempt in xrange(retries + 1):
+                try:
+                    update = not opts.get('noupdate')
+                    if not _fastclone(cui, source, dest, seeds, update):
+                        hg.clone(cui, {}, source, dest, update=update,
+                                 stream=ui.configbool('bb', 'stream'))
+                    break
+                except (util.Abort, error.RepoError, EnvironmentError), e:
+                    if (attempt == retries or os.path.exists(dest) or
+                        400 <= getattr(e, 'code', 0) < 500):
+                        # out of attempts, the destination is in the way or
+                        # the repository is missing: retrying will not help
+                        raise
+                    ui.warn('%s: %s, retrying\n' % (source, e))
+                    time.sleep(2 ** attempt)
+        finally:
+            _tracestop(event)
+        return time.time() - start, _store_size(dest)
+
+    start = time.time()
+    done = failed = total = 0
+    for (source, dest), result, err in _runconcurrently(cloneone, jobs,
+                                                         workers):
+        if err is not None:
+            failed += 1
+            ui.warn('[%d/%d] %s failed: %s\n' % (done + failed, len(jobs),
+                                                  source, err))
+            continue
+        done += 1
+        elapsed, size = result
+        total += size
+        ui.status('[%d/%d] %s -> %s (%.1f s, %.1f MB)\n'
+                  % (done + failed, len(jobs), source, dest, elapsed,
+                     size / 1e6))
+    elapsed = time.time() - start
+    ui.status('cloned %d of %d repositories (%.1f MB) in %.1f s, %.2f MB/s\n'
+              % (done, len(jobs), total / 1e6, elapsed,
+                 total / 1e6 / max(elapsed, 0.001)))
+    if failed:
+        return 1
+
+def clone(orig, ui, source, dest=None, **opts):
+    source = normalize_bburl(source)
+    seeds = ui.configlist('bb', 'seed_repos')
+    seed = opts.pop('seed', None)
+    if seed:
+        seeds.insert(0, seed)
+    stream = opts.pop('stream', None)
+    if not source.startswith('bb'):
+        return orig(ui, source, dest, **opts)
+    if ((seeds or ui.config('bb', 'bundle_store', None)) and
+        not opts.get('rev') and not opts.get('branch') and
+        not opts.get('updaterev')):
+        if _fastclone(ui, source, dest or hg.defaultdest(source), seeds,
+                      not opts.get('noupdate')):
+            return 0
+    if stream or ui.configbool('bb', 'stream'):
+        # hg falls back to a normal clone if the server does not allow it
+        opts['uncompressed'] = True
     return orig(ui, source, dest, **opts)
 
+def pull(orig, ui, repo, source='default', **opts):
+    # apply the changesets kept by bbforks --keep-bundles, then let the pull
+    # download only what is new since
+    if (os.path.isdir(repo.join(bundlecache.dirname)) and
+        not opts.get('rev') and not opts.get('branch') and
+        not opts.get('bookmark')):
+        name = parse_repopath(ui.expandpath(normalize_bburl(source)))
+        bundles = bundlecache(repo, 0)
+        bundle = name and bundles.lookup(name)
+        if bundle:
+            # applied by the repository's pull itself (see reposetup), so
+            # that what comes after it (-u, --rebase, the hint to merge) sees
+            # the kept changesets too
+            repo._bbkept = (name, bundles, bundle)
+            try:
+                return orig(ui, repo, source, **opts)
+            finally:
+                if getattr(repo, '_bbkept', None) is not None:
+                    del repo._bbkept
+    return orig(ui, repo, source, **opts)
+
+def _applybundle(repo, filename):
+    """Add the changesets of the bundle ``filename`` to ``repo``; return
+    what addchangegroup does."""
+    from mercurial import changegroup
+    lock = repo.lock()
+    try:
+        fp = open(filename, 'rb')
+        try:
+            gen = changegroup.readbundle(fp, filename)
+            return repo.addchangegroup(gen, 'unbundle', 'bundle:' + filename)
+        finally:
+            fp.close()
+    finally:
+        lock.release()
+
+def _addmodheads(first, second):
+    """Combine the results of two addchangegroup calls (0 for no changes,
+    1 + the number of heads added, or -1 - the number of heads removed)."""
+    if not first or not second:
+        return first or second
+    if first > 0 and second > 0:
+        return first + second - 1
+    return second
+
+# wire protocol commands whose answer only depends on their arguments, and
+# those whose answer changes with the repository
+PROXY_KEEP = ('getbundle', 'changegroupsubset')
+PROXY_EXPIRE = ('capabilities', 'heads', 'branchmap', 'listkeys', 'known',
+                'lookup', 'batch', 'between', 'branches')
+
+class proxycache(object):
+    """Responses of bitbucket kept by bbproxy in a directory, one file per
+    request, with an ``index`` of their headers, sizes and times.
+
+    An entry expires at the time given when it was stored, if any.  When
+    the responses take more than ``maxsize`` bytes, the least recently
+    served ones are removed.
+    """
+
+    def __init__(self, path, maxsize):
+        import json
+        import threading
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        util.makedirs(path)
+        try:
+            fp = open(os.path.join(path, 'index'))
+            try:
+                self.entries = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _filename(self, key):
+        return os.path.join(self.path, key)
+
+    def tempname(self, key):
+        """Return a new file for a response to ``key`` to be written to."""
+        import tempfile
+        fd, tempname = tempfile.mkstemp(prefix=key + '.', dir=self.path)
+        os.close(fd)
+        return tempname
+
+    def lookup(self, key):
+        """Return the headers and file of the response to ``key``, or
+        None."""
+        self._lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            filename = self._filename(key)
+            if ((entry['expires'] is not None and entry['expires'] < time.time())
+                or not os.path.exists(filename)):
+                self._remove(key)
+                return None
+            entry['time'] = time.time()
+            return entry['headers'], filename
+        finally:
+            self._lock.release()
+
+    def add(self, key, tempname, headers, repo, ttl=None):
+        """Keep the response written to ``tempname`` for ``key``; it is
+        about the repository ``repo`` and expires after ``ttl`` seconds,
+        if given."""
+        self._lock.acquire()
+        try:
+            util.rename(tempname, self._filename(key))
+            now = time.time()
+            self.entries[key] = dict(
+                size=os.path.getsize(self._filename(key)), time=now,
+                expires=ttl is not None and now + ttl or None,
+                headers=headers, repo=repo)
+            self._evict()
+            self._save()
+        finally:
+            self._lock.release()
+
+    def expire(self, repo):
+        """Drop the expiring responses about the repository ``repo``."""
+        self._lock.acquire()
+        try:
+            for key, entry in self.entries.items():
+                if entry['repo'] == repo and entry['expires'] is not None:
+                    self._remove(key)
+            self._save()
+        finally:
+            self._lock.release()
+
+    def _save(self):
+        import json
+        try:
+            fp = util.atomictempfile(os.path.join(self.path, 'index'))
+            fp.write(json.dumps(self.entries))
+            fp.close()
+        except (IOError, OSError):
+            pass
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        try:
+            os.unlink(self._filename(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self.entries.itervalues())
+        byage = sorted(self.entries, key=lambda k: self.entries[k]['time'])
+        while total > self.maxsize and byage:
+            key = byage.pop(0)
+            total -= self.entries[key]['size']
+            self._remove(key)
+
+
+class bbproxy(object):
+    """Answer hg wire protocol requests for ``/user/repo`` with the answers
+    of bitbucket, kept in the proxycache ``cache``.
+
+    Bundles asked for by their heads never change and are kept until they
+    are evicted; heads, bookmarks and the like are reused for ``ttl``
+    seconds, or until a push through the proxy.  Anything else is passed
+    on as it is.  A request that is already being fetched for another
+    client is not sent again, but answered from the cache afterwards.
+    """
+
+    # request headers passed on to bitbucket
+    forward = ('authorization', 'accept', 'content-type')
+    # response headers passed back to the clients (and kept with responses)
+    keepheaders = ('content-type', 'www-authenticate')
+
+    def __init__(self, ui, cache, ttl):
+        import threading
+        self.ui = ui
+        self.cache = cache
+        self.ttl = ttl
+        self.baseurl = get_bburl(ui).rstrip('/')
+        self._lock = threading.Lock()
+        self._fetching = {}
+
+    def handle(self, request):
+        import cgi
+        import urlparse
+        parts = urlparse.urlsplit(request.path)
+        repo = parts[2].strip('/')
+        args = cgi.parse_qs(parts[3], keep_blank_values=True)
+        headers = dict((name, value) for name, value in
+                       request.headers.items()
+                       if name in self.forward or name.startswith('x-hg'))
+        # the arguments of a command may also come in X-HgArg-N headers
+        hgargs = ''.join(headers[name] for name in sorted(
+            (name for name in headers if name.startswith('x-hgarg-')),
+            key=lambda name: int(name[8:])))
+        for name, values in cgi.parse_qs(hgargs,
+                                         keep_blank_values=True).iteritems():
+            args.setdefault(name, []).extend(values)
+        cmd = args.get('cmd', [''])[0]
+        uri = self.baseurl + request.path
+        data = None
+        if request.command == 'POST':
+            length = int(request.headers.get('content-length') or 0)
+            data = request.rfile.read(length)
+        keep = cmd in PROXY_KEEP and 'heads' in args
+        expire = cmd in PROXY_EXPIRE and self.ttl > 0
+        if data is None and (keep or expire):
+            key = util.sha1(repr((repo, sorted(args.items()),
+                                  headers.get('authorization')))).hexdigest()
+            self._cached(request, repo, uri, headers, key,
+                         expire and self.ttl or None)
+        else:
+            self._log(request, 'pass')
+            response = getsession(self.ui).request(uri, data, headers)
+            self._reply(request, response)
+            if cmd in ('unbundle', 'pushkey'):
+                self.cache.expire(repo)
+
+    def _cached(self, request, repo, uri, headers, key, ttl):
+        import threading
+        while True:
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                self._log(request, 'hit')
+                fp = open(cached[1], 'rb')
+                try:
+                    self._reply(request, fp, 200, cached[0],
+                                os.fstat(fp.fileno()).st_size)
+                finally:
+                    fp.close()
+                return
+            self._lock.acquire()
+            try:
+                fetching = self._fetching.get(key)
+                if fetching is None:
+                    self._fetching[key] = threading.Event()
+            finally:
+                self._lock.release()
+            if fetching is None:
+                break
+            # another client asked for the same: wait for it to be kept
+            while not fetching.isSet():
+                fetching.wait(0.1)
+        self._log(request, 'miss')
+        try:
+            response = getsession(self.ui).request(uri, None, headers)
+            if response.status != 200:
+                self._reply(request, response)
+                return
+            tempname = self.cache.tempname(key)
+            fp = open(tempname, 'wb')
+            try:
+                complete = self._reply(request, response, tee=fp)
+            finally:
+                fp.close()
+            if complete:
+                self.cache.add(key, tempname, self._headers(response), repo,
+                               ttl)
+            else:
+                os.unlink(tempname)
+        finally:
+            self._lock.acquire()
+            try:
+                self._fetching.pop(key).set()
+            finally:
+                self._lock.release()
+
+    def _headers(self, response):
+        return [(name, response.getheader(name)) for name in self.keepheaders
+                if response.getheader(name) is not None]
+
+    def _reply(self, request, fp, status=None, headers=None, length=None,
+               tee=None):
+        """Send the response ``fp`` to the client; return whether all of
+        it was read (and written to ``tee``, if given)."""
+        import socket
+        if status is None:
+            status, headers = fp.status, self._headers(fp)
+        complete = False
+        try:
+            try:
+                request.send_response(status)
+                for name, value in headers:
+                    request.send_header(name, value)
+                if length is not None:
+                    request.send_header('Content-Length', str(length))
+                request.end_headers()
+                while True:
+                    data = fp.read(1 << 16)
+                    if not data:
+                        complete = True
+                        break
+                    if tee is not None:
+                        tee.write(data)
+                    request.wfile.write(data)
+            except socket.error:
+                # the client went away; what was read may still be kept
+                if tee is not None:
+                    while True:
+                        data = fp.read(1 << 16)
+                        if not data:
+                            complete = True
+                            break
+                        tee.write(data)
+        finally:
+            fp.close()
+        return complete
+
+    def _log(self, request, what):
+        self.ui.note('%s %s %s\n' % (request.command, request.path, what))
+
+def bb_proxy(ui, **opts):
+    '''serve bitbucket repositories through a local caching proxy
+
+    Start an HTTP server that answers the requests of Mercurial clients for
+    ``http://ADDRESS:PORT/user/repo`` with the answers of bitbucket, keeping
+    them in ``bb.proxy_cache_dir`` (``~/.cache/hgbb/proxy`` by default) up
+    to ``bb.proxy_cache_size`` megabytes (1024 by default).  The changesets
+    of a repository are then only downloaded from bitbucket once for all
+    the clients of the proxy.  Heads, bookmarks and other answers that
+    change with the repository are reused for ``bb.proxy_ttl`` seconds (30
+    by default).
+
+    Clients set ``bb.proxy`` to the URL of the proxy to reach ``bb://``
+    repositories through it.  Answers are kept separately for every set of
+    credentials.
+    '''
+    httpd = proxyserver(ui, opts.get('address') or '', opts.get('port'))
+    address, port = httpd.server_address[:2]
+    ui.status('listening at http://%s:%d/ (caching in %s)\n'
+              % (address, port, httpd.proxy.cache.path))
+    httpd.serve_forever()
+
+def proxyserver(ui, address, port):
+    """Return the HTTP server of bbproxy for ``address`` and ``port``; it
+    answers requests once it is told to serve."""
+    import BaseHTTPServer
+    import SocketServer
+    path = ui.config('bb', 'proxy_cache_dir') or usercache('proxy').filename
+    size = ui.configint('bb', 'proxy_cache_size', 1024)
+    proxy = bbproxy(ui, proxycache(path, size << 20),
+                    ui.configint('bb', 'proxy_ttl', 30))
+    getsession(ui)
+
+    class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                proxy.handle(self)
+            except Exception, e:
+                ui.warn('%s %s: %s\n' % (self.command, self.path, e))
+                try:
+                    self.send_error(502, str(e))
+                except Exception:
+                    pass
+        do_POST = do_GET
+        def log_message(self, format, *args):
+            pass
+
+    class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 128
+
+    httpd = server((address, port), handler)
+    httpd.proxy = proxy
+    return httpd
+
+
 def uisetup(ui):
-    extensions.wrapcommand(commands.table, 'clone', clone)
+    entry = extensions.wrapcommand(commands.table, 'clone', clone)
+    entry[1].append(('', 'seed', '',
+                     'local repository to reuse the shared history of '
+                     '(bb:// sources only)'))
+    entry[1].append(('', 'stream', None,
+                     'ask for an uncompressed streaming clone '
+                     '(bb:// sources only)'))
+    extensions.wrapcommand(commands.table, 'pull', pull)
+
+def reposetup(ui, repo):
+    if not repo.local():
+        return
+
+    class keptbundlesrepo(repo.__class__):
+        def pull(self, remote, *args, **kwargs):
+            # the changesets kept by bbforks --keep-bundles, if the pull
+            # command found some for this fork
+            kept = getattr(self, '_bbkept', None)
+            orig = super(keptbundlesrepo, self).pull
+            if kept is None:
+                return orig(remote, *args, **kwargs)
+            del self._bbkept
+            name, bundles, bundle = kept
+            self.ui.status('applying changesets of %s kept by bbforks\n'
+                           % name)
+            modheads = 0
+            try:
+                modheads = _applybundle(self, bundle)
+            except (util.Abort, error.LookupError, IOError), e:
+                self.ui.warn('cannot use the kept changesets of %s: %s\n'
+                             % (name, e))
+            bundles.discard(name)
+            return _addmodheads(modheads, orig(remote, *args, **kwargs))
+
+    repo.__class__ = keptbundlesrepo
 
 
 hg.schemes['bb'] = auto_bbrepo()
 hg.schemes['bb+http'] = bbrepo(
-    httprepo_instance, 'https://%(auth)sbitbucket.org/%(path)s')
+    httprepo_instance, '%(scheme)s://%(auth)s%(host)s/%(path)s')
 hg.schemes['bb+https'] = bbrepo(
-    httprepo_instance, 'https://%(auth)sbitbucket.org/%(path)s')
+    httprepo_instance, '%(scheme)s://%(auth)s%(host)s/%(path)s')
 hg.schemes['bb+ssh'] = bbrepo(
     sshrepo_instance, 'ssh://hg@bitbucket.org/%(path)s')
 
 cmdtable = {
     'bbforks':
-        (bb_forks,
+        (_traced(bb_forks),
          [('n', 'reponame', '',
            'name of the repo at bitbucket (else guessed from repo dir)'),
           ('i', 'incoming', None, 'look for incoming changesets'),
           ('o', 'outgoing', None, 'look for outgoing changesets'),
           ('f', 'full', None, 'show full incoming info'),
-          ],
-         'hg bbforks [-i/-o [-f]] [-n reponame]'),
+          ('', 'refresh', None, 'ignore the cached list of forks'),
+          ('', 'mirror', None, 'keep fork changesets in a local mirror'),
+          ('', 'count', None, 'only count incoming/outgoing changesets'),
+          ('', 'json', None, 'print the counts as one JSON record per fork'),
+          ('', 'keep-bundles', None,
+           'keep incoming changesets for a later pull of the fork'),
+          ('', 'active-since', '',
+           'only forks updated since DATE (or -N days)', 'DATE'),
+          ('', 'limit', 0, 'only the N most recently updated forks', 'N'),
+          ('r', 'recursive', None, 'include the forks of the forks'),
+          ('', 'depth', 0, 'levels of forks to include with --recursive'),
+          ('', 'single-pass', None,
+           'find the outgoing changesets of all forks at once'),
+          ] + traceopts,
+         'hg bbforks [-i/-o [-f|--count|--json] [--mirror]] [-n reponame] '
+         '[--refresh] [-r [--depth n]] [--active-since DATE] [--limit N] '
+         '[-o --single-pass]'),
     'bbcreate':
-        (bb_create,
+        (_traced(bb_create),
          [('d', 'description', '', 'description of the new repo'),
           ('l', 'language', '', 'programming language'),
           ('w', 'website', '', 'website of the project'),
           ('p', 'private', None, 'is this repo private?'),
           ('n', 'noclone', None, 'skip cloning?'),
-          ],
-         'hg bbcreate [-d desc] [-l lang] [-w site] [-p] [-n] reponame'),
+          ('', 'batch', '',
+           'create and push the local repositories listed in FILE', 'FILE'),
+          ('j', 'jobs', 0, 'number of repositories to create at the same time'),
+          ] + traceopts,
+         'hg bbcreate [-d desc] [-l lang] [-w site] [-p] '
+         '[-n] reponame | --batch FILE [-j jobs]'),
     'bbfollowers':
-        (bb_followers,
+        (_traced(bb_followers),
          [('n', 'reponame', '',
            'name of the repo at bitbucket (else guessed from repo dir)'),
+          ('', 'refresh', None, 'ignore the cached list of followers'),
+          ('', 'json', None, 'print one JSON record per follower'),
+          ] + traceopts,
+         'hg bbfollowers [-n reponame] [--refresh] [--json]'),
+    'bbclone-many':
+        (_traced(bb_clone_many),
+         [('j', 'jobs', 0, 'number of repositories to clone at the same time'),
+          ('', 'retries', 2, 'how often to retry a failed clone'),
+          ('U', 'noupdate', None, 'the clones will have an empty working copy'),
+          ] + traceopts,
+         'hg bbclone-many [-j jobs] [--retries n] [-U] MANIFEST'),
+    'bbproxy':
+        (bb_proxy,
+         [('a', 'address', '', 'address to listen on (default: all)'),
+          ('p', 'port', 8000, 'port to listen on (default: 8000)'),
           ],
-         'hg bbfollowers [-n reponame]'),
+         'hg bbproxy [-a address] [-p port]'),
     'bblink':
         (bb_link,
-         [('l', 'lineno', -1, 'line number')],
-         'hg bblink [-l lineno] filename'),
+         [('l', 'lineno', -1, 'line number'),
+          ('n', 'reponame', '',
+           'name of the repo at bitbucket (else guessed from repo dir)'),
+          ('', 'stdin', None, 'read FILE[:LINENO] lines from standard input'),
+          ],
+         'hg bblink [-l lineno] [-n reponame] filename | --stdin'),
 }
 
-commands.norepo += ' bbcreate'
+commands.norepo += ' bbcreate bbclone-many bbproxy'
+commands.optionalrepo += ' bbfollowers'
@@ -15,9 +15,21 @@ def pytest_funcarg__ui(request):
     def printstatus(status, **kw):
         print status[:-1], kw # strip hg ui newlines, evil
     mock_ui.status.side_effect = printstatus
+    mock_ui.configint.side_effect = lambda section, name, default=None: default
+    mock_ui.configbool.side_effect = lambda section, name, default=False: default
+    mock_ui.configlist.return_value = []
     return mock_ui
 
 
+def pytest_funcarg__baseui(request):
+    """A real ui for repositories made in the test, committing as "test"."""
+    from mercurial import ui as uimod
+    baseui = uimod.ui()
+    baseui.setconfig('ui', 'username', 'test')
+    baseui.setconfig('ui', 'quiet', 'True')
+    return baseui
+
+
 def pytest_generate_tests(metafunc):
     if 'path' in metafunc.funcargnames:
         for id, path, expected_name in parse_repopath_cases:
@@ -90,6 +102,7 @@ def test_get_reponame(monkeypatch, ui):
 
 
 def test_clone_wrapper_path_mapping(ui):
+    ui.config.return_value = None
     mock = Mock()
     hgbb.clone(mock, ui, 'bb:test')
     #                       ui,   source,      dest
@@ -107,10 +120,13 @@ def test_clone_wrapper_path_mapping(ui):
 
 
 def test_uisetup(monkeypatch, ui):
-    mock = Mock()
+    options = []
+    mock = Mock(return_value=(None, options, ''))
     monkeypatch.setattr(extensions, 'wrapcommand', mock)
     hgbb.uisetup(ui)
-    mock.assert_called_with(commands.table, 'clone', hgbb.clone)
+    mock.assert_any_call(commands.table, 'clone', hgbb.clone)
+    mock.assert_any_call(commands.table, 'pull', hgbb.pull)
+    assert [o[1] for o in options] == ['seed', 'stream']
 
 
 def test_auto_bbrepo(monkeypatch, ui):
@@ -162,12 +178,24 @@ example_bbforks_page_no_forks = """
 """
 
 
+def fake_page(body, status=200):
+    response = Mock()
+    response.status = status
+    response.read = py.io.BytesIO(body).read
+    response.getheader.return_value = None
+    return response
+
+
+def fake_session(monkeypatch, **kw):
+    session = Mock()
+    session.request = Mock(**kw)
+    monkeypatch.setattr(hgbb, 'getsession', Mock(return_value=session))
+    return session.request
+
+
 def test_list_forks_no_forks(monkeypatch):
-    import lxml.html
-    parse = Mock()
-    io = py.io.BytesIO(example_bbforks_page_no_forks)
-    parse.return_value = lxml.html.parse(io)
-    monkeypatch.setattr(lxml.etree, 'parse', parse)
+    fake_session(monkeypatch,
+                 return_value=fake_page(example_bbforks_page_no_forks))
     repos = hgbb.list_forks('testrepo')
     assert not repos
 
@@ -195,29 +223,70 @@ example_bbforks_page_with_forks = """
 
 
 def test_list_forks_with_forks(monkeypatch):
-    import lxml.html
-    parse = Mock()
-    io = py.io.BytesIO(example_bbforks_page_with_forks)
-    parse.return_value = lxml.html.parse(io)
-    monkeypatch.setattr(lxml.html, 'parse', parse)
+    fake_session(monkeypatch,
+                 return_value=fake_page(example_bbforks_page_with_forks))
     repos = hgbb.list_forks('testrepo')
     print repos
     assert repos == ['special/testrepo', 'special/testrepo2']
 
 
+example_bbforks_page_paginated = """
+<div class="forks pane">
+    <h2>Forks</h2>
+    <ol class="detailed iterable">
+        <li>
+            <dd class="name"><a href="/first">first</a> / <a href="/first/testrepo">ow</a></dd>
+        </li>
+    </ol>
+    <ol class="paginator"><li class="next"><a href="?page=2">next</a></li></ol>
+    <h2>Patch queues</h2>
+</div>
+"""
+
+
+def test_list_forks_paginated(monkeypatch):
+    request = fake_session(monkeypatch, side_effect=[
+        fake_page(example_bbforks_page_paginated),
+        fake_page(example_bbforks_page_with_forks)])
+    repos = hgbb.list_forks('testrepo')
+    assert repos == ['first/testrepo',
+                     'special/testrepo', 'special/testrepo2']
+    assert request.call_args[0][0] == \
+        'https://bitbucket.org/testrepo/descendants/?page=2'
+
+
+def test_list_forks_traced(monkeypatch):
+    tracer = hgbb.bbtracer()
+    monkeypatch.setattr(hgbb, '_tracer', tracer)
+    fake_session(monkeypatch, side_effect=[
+        fake_page(example_bbforks_page_paginated),
+        fake_page(example_bbforks_page_with_forks)])
+    assert len(hgbb.list_forks('testrepo')) == 3
+    # one phase per page, however the forks are handed out
+    assert [(e['name'], e['target']) for e in tracer.events] == [
+        ('list_forks', 'testrepo page 1'), ('list_forks', 'testrepo page 2')]
+
+
 def test_list_forks_failes(monkeypatch):
-    import lxml.html
-    parse = Mock()
-    parse.side_effect = IOError('example failure')
-    monkeypatch.setattr(lxml.html, 'parse', parse)
+    fake_session(monkeypatch, side_effect=IOError('example failure'))
     py.test.raises(util.Abort, hgbb.list_forks, 'testrepo')
 
 
+def test_list_forks_unknown_page(monkeypatch):
+    fake_session(monkeypatch, return_value=fake_page(
+        '<html><h1>Bitbucket is down for maintenance</h1></html>'))
+    cache = Mock(refresh=False)
+    cache.lookup.return_value = None
+    py.test.raises(util.Abort, hgbb.list_forks, 'testrepo', cache)
+    # nothing is cached for the next time
+    assert not cache.store.called
+
+
 def test_bbforks_no_forks(monkeypatch, ui):
-    list_forks = Mock(return_value=None)
+    list_forks = Mock(return_value=[])
     incoming = Mock(name='incoming', spec=commands.incoming)
     reponame = Mock(return_value = [])
-    monkeypatch.setattr(hgbb, 'list_forks', list_forks)
+    monkeypatch.setattr(hgbb, 'iter_forks', list_forks)
     monkeypatch.setattr(hgbb, 'get_bbreponame', reponame)
     monkeypatch.setattr(commands, 'incoming', incoming)
     hgbb.bb_forks(ui, None)
@@ -233,11 +302,12 @@ def test_bbforks_some_forks(monkeypatch, ui):
     ui.popbuffer.return_value = '\xff'
 
     list_forks = Mock(return_value=['some', 'other', 'moar'])
-    incoming = Mock(name='incoming', spec=commands.incoming)
+    incoming = Mock(name='incoming', return_value=(None, [], Mock()))
     reponame = Mock(return_value=[])
-    monkeypatch.setattr(hgbb, 'list_forks', list_forks)
+    monkeypatch.setattr(hgbb, 'iter_forks', list_forks)
     monkeypatch.setattr(hgbb, 'get_bbreponame', reponame)
-    monkeypatch.setattr(commands, 'incoming', incoming)
+    monkeypatch.setattr(hgbb, '_fork_changes', incoming)
+    monkeypatch.setattr(hg, 'peer', Mock())
 
     hgbb.bb_forks(ui, None)
     hgbb.bb_forks(ui, None, incoming=True)
@@ -245,3 +315,963 @@ def test_bbforks_some_forks(monkeypatch, ui):
     assert incoming.call_count==2
 
 
+def test_runconcurrently_keeps_order():
+    def func(item):
+        if item == 2:
+            raise util.Abort('broken')
+        return item * 10
+    for workers in (1, 3):
+        results = list(hgbb._runconcurrently(func, range(5), workers))
+        assert [r[0] for r in results] == range(5)
+        assert [r[1] for r in results] == [0, 10, None, 30, 40]
+        assert isinstance(results[2][2], util.Abort)
+
+
+def test_threadsaferevsets(monkeypatch):
+    from mercurial import revset, parser
+    # a parse function (Mercurial 3.0 and later) is left alone
+    parse = lambda spec, lookup=None: spec
+    monkeypatch.setattr(revset, 'parse', parse)
+    list(hgbb._runconcurrently(lambda item: item, range(5), 3))
+    assert revset.parse is parse
+
+    # a shared parser object gets replaced by a fresh parser per query
+    shared = parser.parser(revset.tokenize, revset.elements)
+    monkeypatch.setattr(revset, 'parse', shared.parse)
+    hgbb._threadsaferevsets()
+    assert getattr(revset.parse, 'im_self', None) is None
+    spec = 'heads(all()) and not secret()'
+    assert revset.parse(spec) == shared.parse(spec)
+    threadsafe = revset.parse
+    hgbb._threadsaferevsets()
+    assert revset.parse is threadsafe
+
+
+def test_bbforks_concurrent(monkeypatch, ui):
+    ui.configint.side_effect = lambda section, name, default=None: 4
+    ui.configbool.side_effect = lambda section, name, default=False: False
+    ui.configlist.return_value = []
+    ui.copy.return_value = ui
+    ui.popbuffer.return_value = '\xff'
+    monkeypatch.setattr(hg, 'repository', Mock())
+
+    list_forks = Mock(return_value=['some', 'other', 'moar'])
+    incoming = Mock(name='incoming', return_value=(None, [], Mock()))
+    monkeypatch.setattr(hgbb, 'iter_forks', list_forks)
+    monkeypatch.setattr(hgbb, 'get_bbreponame', Mock(return_value=[]))
+    monkeypatch.setattr(hgbb, '_fork_changes', incoming)
+    monkeypatch.setattr(hg, 'peer', Mock())
+
+    repo = Mock()
+    repo.opener.side_effect = IOError('no cached forks')
+    hgbb.bb_forks(ui, repo, incoming=True)
+
+    assert incoming.call_count == 3
+    looked_at = [c[0][0] for c in ui.status.call_args_list
+                 if c[0][0].startswith('looking at')]
+    assert looked_at == ['looking at some\n', 'looking at other\n',
+                         'looking at moar\n']
+
+
+def test_list_forks_cached(monkeypatch):
+    import time
+    request = fake_session(monkeypatch, side_effect=IOError('no network'))
+    repo = Mock()
+    repo.opener.side_effect = IOError('no cache yet')
+    cache = hgbb.forkcache(repo, ttl=60)
+    cache.entries['testrepo'] = dict(forks=['special/testrepo'], etag='"x"',
+                                     modified=None, time=time.time())
+    assert hgbb.list_forks('testrepo', cache) == ['special/testrepo']
+    assert not request.called
+
+    # stale entries are revalidated with the stored etag
+    request.side_effect = None
+    request.return_value = fake_page('', status=304)
+    cache.ttl = 0
+    assert hgbb.list_forks('testrepo', cache) == ['special/testrepo']
+    headers = request.call_args[1]['headers']
+    assert headers['If-None-Match'] == '"x"'
+
+
+def test_bbresponse_gzip():
+    import gzip
+    io = py.io.BytesIO()
+    gz = gzip.GzipFile(fileobj=io, mode='wb')
+    gz.write('x' * 20000)
+    gz.close()
+    raw = Mock()
+    raw.read = py.io.BytesIO(io.getvalue()).read
+    raw.getheader.return_value = 'gzip'
+    raw.will_close = False
+    session = Mock()
+    conn = Mock()
+    response = hgbb.bbresponse(session, ('https', 'bitbucket.org'), conn, raw)
+    assert response.read(100) == 'x' * 100
+    assert not session._release.called
+    assert response.read() == 'x' * 19900
+    # the connection is kept alive for the next request
+    session._release.assert_called_with(('https', 'bitbucket.org'), conn)
+
+
+def test_bb_apicall_error(monkeypatch, ui):
+    import urllib2
+    fake_session(monkeypatch, return_value=fake_page('', status=404))
+    py.test.raises(urllib2.HTTPError, hgbb._bb_apicall, ui, 'users/x', None)
+
+
+def make_commit(repo, filename, text):
+    repo.wopener.write(filename, text)
+    commands.commit(repo.ui, repo, message=text, addremove=True)
+
+
+def make_repo(ui, path, *commits):
+    """Create a repository at ``path`` with the (filename, text) commits."""
+    repo = hg.repository(ui, str(path), create=True)
+    for filename, text in commits:
+        make_commit(repo, filename, text)
+    return repo
+
+
+def fake_peers(monkeypatch, paths):
+    """Let hg.peer open the local repositories ``paths`` maps URLs to."""
+    peer = hg.peer
+    def fakepeer(uiorrepo, opts, path, create=False):
+        return peer(uiorrepo, opts, paths.get(path, path), create)
+    monkeypatch.setattr(hg, 'peer', fakepeer)
+
+
+def test_forkmirror(monkeypatch, tmpdir, baseui):
+    from mercurial import phases
+    local = make_repo(baseui, tmpdir.join('local'), ('a', 'shared'))
+    forkpath = str(tmpdir.join('fork'))
+    hg.clone(baseui, {}, local.root, forkpath)
+    fork = hg.repository(baseui, forkpath)
+    make_commit(fork, 'b', 'fork only')
+    make_commit(local, 'c', 'local only')
+    # a secret head is neither in the mirror nor outgoing
+    make_commit(local, 'd', 'secret')
+    phases.retractboundary(local, phases.secret, [local['tip'].node()])
+    fake_peers(monkeypatch, {'bb://other/fork': forkpath})
+
+    templateopts = {'template': hgbb.FULL_TMPL}
+    mirror = hgbb.forkmirror(baseui, local)
+    contents = mirror.scan(baseui, 'other/fork', 'incoming', templateopts)
+    assert contents.count('\xff') == 1
+    assert 'fork only' in contents
+    contents = mirror.scan(baseui, 'other/fork', 'outgoing', templateopts)
+    assert contents.count('\xff') == 1
+    assert 'local only' in contents
+
+
+def test_stream_fork(monkeypatch, tmpdir, baseui):
+    local = make_repo(baseui, tmpdir.join('local'), ('a', 'shared'))
+    forkpath = str(tmpdir.join('fork'))
+    hg.clone(baseui, {}, local.root, forkpath)
+    make_commit(hg.repository(baseui, forkpath), 'b', 'fork only')
+    fake_peers(monkeypatch, {'bb://other/fork': forkpath})
+
+    baseui.setconfig('ui', 'quiet', 'False')
+    baseui.pushbuffer()
+    number, contents = hgbb._stream_fork(baseui, local, 'incoming',
+                                         'other/fork',
+                                         {'template': hgbb.FULL_TMPL})
+    output = baseui.popbuffer()
+    assert number == 1
+    assert 'fork only' in contents
+    # the summary comes first, as in the other modes
+    assert output.index('1 incoming changeset found in bb://other/fork') < \
+        output.index('fork only')
+
+
+def test_forkstate():
+    repo = MagicMock()
+    repo.heads.return_value = ['\0' * 20]
+    repo.__len__.return_value = 1
+    repo.opener.side_effect = IOError('no state yet')
+    state = hgbb.forkstate(repo)
+    heads = ['\1' * 20]
+    assert state.lookup('other/fork', 'incoming', heads) is None
+    state.store('other/fork', 'incoming', heads, '\xff\xff')
+    assert state.lookup('other/fork', 'incoming', heads) == '\xff\xff'
+    assert state.lookup('other/fork', 'outgoing', heads) is None
+    assert state.lookup('other/fork', 'incoming', ['\2' * 20]) is None
+    # too large a result is not kept
+    state.store('other/fork', 'incoming', heads, 'x' * (hgbb.STATE_KEEP + 1))
+    assert state.lookup('other/fork', 'incoming', heads) is None
+    state.store('other/fork', 'incoming', heads, '\xff\xff')
+    # a changed local repository invalidates the results
+    repo.__len__.return_value = 2
+    newstate = hgbb.forkstate(repo)
+    newstate.entries = state.entries
+    assert newstate.lookup('other/fork', 'incoming', heads) is None
+
+
+def test_traced_command(ui, tmpdir):
+    def command(ui, **opts):
+        outer = hgbb._tracestart('apicall', 'users/x')
+        inner = hgbb._tracestart('auth')
+        hgbb._tracecount(bytes=10, roundtrips=1)
+        hgbb._tracestop(inner)
+        hgbb._tracecount(bytes=5)
+        hgbb._tracestop(outer)
+        hgbb._tracestop(hgbb._tracestart('peer', 'bb://x/y'))
+        # a paused phase is not charged for what happens meanwhile
+        page = hgbb._tracestart('list_forks', 'x/y page 1')
+        hgbb._tracecount(bytes=3, roundtrips=1)
+        hgbb._tracepause(page)
+        hgbb._tracecount(bytes=100)
+        hgbb._traceresume(page)
+        hgbb._tracestop(page)
+    traced = hgbb._traced(command)
+    trace = tmpdir.join('trace.json')
+    traced(ui, timings=True, trace=str(trace))
+    assert hgbb._tracer is None
+    report = ''.join(c[0][0] for c in ui.write.call_args_list)
+    # the traffic of peers is not measured
+    assert report.split('\npeer ')[1].split()[-2:] == ['-', '-']
+
+    import json
+    events = json.loads(trace.read())['events']
+    names = [(e['name'], e['bytes'], e['roundtrips']) for e in events]
+    assert names == [('command', 118, 2), ('apicall', 15, 1), ('auth', 10, 1),
+                     ('peer', None, None), ('list_forks', 3, 1)]
+    assert sorted(events[-1]) == ['bytes', 'duration', 'name', 'roundtrips',
+                                  'start', 'target', 'thread']
+
+
+def test_countingui():
+    from mercurial import ui as uimod
+    target = uimod.ui()
+    target.pushbuffer()
+    sui = hgbb._countingui(target, 10)
+    sui.write('\xffone\n')
+    assert target.popbuffer() == 'one\n'
+    target.pushbuffer()
+    sui.write('\xfftwo\n', '\xffthree\n')
+    assert target.popbuffer() == 'two\nthree\n'
+    assert sui.changesets == 3
+    # more than 10 bytes of output are not kept
+    assert sui.kept is None
+
+
+def test_bbforks_json(monkeypatch, ui):
+    import json
+    monkeypatch.setattr(hgbb, 'iter_forks', Mock(return_value=['a/r', 'b/r']))
+    monkeypatch.setattr(hgbb, 'get_bbreponame', Mock(return_value='me/r'))
+    peer = Mock()
+    peer.heads.return_value = ['\1' * 20]
+    def fakepeer(ui, opts, path):
+        if path == 'bb://b/r':
+            raise util.Abort('no such fork')
+        return peer
+    monkeypatch.setattr(hg, 'peer', fakepeer)
+    monkeypatch.setattr(hgbb, '_count_changesets', Mock(return_value=3))
+
+    hgbb.bb_forks(ui, None, json=True, incoming=True)
+
+    records = [json.loads(c[0][0]) for c in ui.write.call_args_list]
+    assert records == [
+        dict(fork='a/r', heads=['01' * 20], incoming=3, error=None),
+        dict(fork='b/r', heads=None, error='no such fork'),
+    ]
+
+
+def test_bblink_stdin(tmpdir, baseui):
+    from mercurial.node import short
+    baseui.setconfig('bb', 'username', 'me')
+    repo = make_repo(baseui, tmpdir.join('repo'), ('a', 'first'))
+    first = short(repo['tip'].node())
+
+    ui = repo.ui
+    ui.fin = py.io.BytesIO('%s:12\n\n' % repo.wjoin('a'))
+    ui.pushbuffer()
+    hgbb.bb_link(ui, repo, stdin=True, lineno=-1)
+    assert ui.popbuffer().splitlines() == [
+        'https://bitbucket.org/me/repo/src/%s/a#cl-12' % first,
+        'https://bitbucket.org/me/repo/src/%s/' % first,
+    ]
+
+    # a new working directory parent is noticed
+    make_commit(repo, 'a', 'second')
+    ui.pushbuffer()
+    hgbb.bb_link(ui, repo, repo.wjoin('a'), lineno=-1)
+    assert ui.popbuffer() == 'https://bitbucket.org/me/repo/src/%s/a\n' % \
+        short(repo['tip'].node())
+
+
+def test_bbclone_many(monkeypatch, tmpdir):
+    from mercurial import ui as uimod
+    ui = uimod.ui()
+    ui.setconfig('bb', 'username', 'me')
+    ui.setconfig('bb', 'password', 'secret')
+    manifest = tmpdir.join('manifest')
+    manifest.write('# repositories\nbb:a/one\n\nb/two other\nc/bad\n')
+    failures = {}
+    def fakeclone(ui, peeropts, source, dest, update=True, stream=False):
+        if source == 'bb://c/bad':
+            failures[source] = failures.get(source, 0) + 1
+            raise util.Abort('no such repository')
+        tmpdir.join(dest, '.hg', 'store').ensure(dir=True)
+    clone = Mock(side_effect=fakeclone)
+    monkeypatch.setattr(hg, 'clone', clone)
+    monkeypatch.setattr(hgbb.time, 'sleep', Mock())
+    monkeypatch.chdir(tmpdir)
+
+    ui.pushbuffer()
+    assert hgbb.bb_clone_many(ui, str(manifest), jobs=2, retries=1) == 1
+    output = ui.popbuffer()
+
+    sources = sorted((c[0][2], c[0][3]) for c in clone.call_args_list)
+    assert sources == [('bb://a/one', 'one'), ('bb://b/two', 'other'),
+                       ('bb://c/bad', 'bad'), ('bb://c/bad', 'bad')]
+    assert failures == {'bb://c/bad': 2}
+    assert 'bb://a/one -> one' in output
+    assert 'cloned 2 of 3 repositories' in output
+
+
+def test_bbclone_many_overlap(monkeypatch, tmpdir):
+    import threading
+    from mercurial import ui as uimod
+    ui = uimod.ui()
+    ui.setconfig('bb', 'username', 'me')
+    ui.setconfig('bb', 'password', 'secret')
+    manifest = tmpdir.join('manifest')
+    manifest.write('a/one\nb/two\n')
+    started = []
+    both = threading.Event()
+    def fakeclone(ui, peeropts, source, dest, update=True, stream=False):
+        started.append(source)
+        if len(started) == 2:
+            both.set()
+        # neither clone finishes before the other one has started
+        assert both.wait(5)
+        tmpdir.join(dest, '.hg', 'store').ensure(dir=True)
+    monkeypatch.setattr(hg, 'clone', fakeclone)
+    monkeypatch.chdir(tmpdir)
+
+    ui.pushbuffer()
+    assert not hgbb.bb_clone_many(ui, str(manifest), jobs=2)
+    assert 'cloned 2 of 2 repositories' in ui.popbuffer()
+
+
+def test_seeded_clone(monkeypatch, tmpdir, baseui):
+    local = make_repo(baseui, tmpdir.join('local'), ('a', 'shared'))
+    forkpath = str(tmpdir.join('fork'))
+    hg.clone(baseui, {}, local.root, forkpath)
+    make_commit(hg.repository(baseui, forkpath), 'b', 'fork only')
+    unrelated = make_repo(baseui, tmpdir.join('unrelated'),
+                          ('a', 'unrelated'))
+    fake_peers(monkeypatch, {'bb://other/fork': forkpath})
+    baseui.setconfig('bb', 'seed_repos', unrelated.root)
+    orig = Mock()
+    dest = str(tmpdir.join('dest'))
+
+    # the shared history is copied, and only the fork's changeset pulled
+    hgbb.clone(orig, baseui, 'bb:other/fork', dest, seed=local.root)
+    assert not orig.called
+    clone = hg.repository(baseui, dest)
+    assert [clone[r].description() for r in clone] == ['shared', 'fork only']
+    assert clone.wopener.read('b') == 'fork only'
+    assert clone.ui.config('paths', 'default') == 'bb://other/fork'
+
+    # changesets the fork does not have are not copied either
+    make_commit(local, 'c', 'local only')
+    hgbb.clone(orig, baseui, 'bb:other/fork', dest + '2', seed=local.root,
+               noupdate=True)
+    clone = hg.repository(baseui, dest + '2')
+    assert [clone[r].description() for r in clone] == ['shared', 'fork only']
+
+    # without a related repository, the normal clone is used
+    hgbb.clone(orig, baseui, 'bb:other/fork', dest + '3')
+    orig.assert_called_with(baseui, 'bb://other/fork', dest + '3')
+
+
+def test_sshmultiplex(monkeypatch):
+    import os
+    import atexit
+    import subprocess
+    from mercurial import ui as uimod
+    register = Mock()
+    monkeypatch.setattr(atexit, 'register', register)
+    monkeypatch.setattr(hgbb, '_sshcontrol', {})
+    ui = uimod.ui()
+    ui.setconfig('ui', 'ssh', 'ssh -C')
+
+    sshcmd = hgbb._sshmultiplex(ui).config('ui', 'ssh')
+    assert sshcmd.startswith('ssh -C -o ControlMaster=auto -o ControlPath=')
+    controldir = hgbb._sshcontrol['dir']
+    assert controldir in sshcmd
+    # a master left behind does not live forever
+    assert sshcmd.endswith(' -o ControlPersist=60')
+    # every peer uses the same master, which is stopped once at exit
+    assert hgbb._sshmultiplex(ui).config('ui', 'ssh') == sshcmd
+    register.assert_called_once_with(hgbb._sshcleanup, 'ssh -C', controldir)
+    assert ui.config('ui', 'ssh') == 'ssh -C'
+
+    ui.setconfig('bb', 'ssh_multiplex', 'false')
+    assert hgbb._sshmultiplex(ui) is ui
+    ui.setconfig('bb', 'ssh_multiplex', 'true')
+    ui.setconfig('ui', 'ssh', 'plink -batch')
+    assert hgbb._sshmultiplex(ui) is ui
+
+    open(os.path.join(controldir, 'hg@bitbucket.org:22'), 'w').close()
+    call = Mock()
+    monkeypatch.setattr(subprocess, 'call', call)
+    hgbb._sshcleanup('ssh -C', controldir)
+    cmd = call.call_args[0][0]
+    assert cmd.startswith('ssh -C -o ControlPath=')
+    assert cmd.endswith(" -O exit -p 22 'hg@bitbucket.org'")
+    assert not os.path.exists(controldir)
+    assert hgbb._sshcontrol == {}
+
+
+def test_iter_forktree(monkeypatch, ui):
+    tree = {
+        'me/r': ['a/r', 'b/r', 'x/r'],
+        'a/r': ['c/r', 'b/r', 'me/r'],
+        'b/r': ['d/r'],
+        'c/r': ['e/r'],
+        'x/r': ['hidden/r'],
+    }
+    listed = []
+    def fake_iter_forks(reponame, cache=None, baseurl=None):
+        listed.append(reponame)
+        if reponame == 'd/r':
+            raise util.Abort('gone')
+        return iter(tree.get(reponame, []))
+    monkeypatch.setattr(hgbb, 'iter_forks', fake_iter_forks)
+    ui.config.return_value = None
+    ui.configint.side_effect = lambda section, name, default=None: 2
+
+    forks = list(hgbb.iter_forktree(ui, 'me/r', ignore=['x/r']))
+    assert forks == ['a/r', 'b/r', 'c/r', 'd/r', 'e/r']
+    # ignored forks are not crawled, and every fork is listed once
+    assert sorted(listed) == ['a/r', 'b/r', 'c/r', 'd/r', 'e/r', 'me/r']
+    assert 'd/r' in ui.warn.call_args[0][0]
+
+    del listed[:]
+    forks = list(hgbb.iter_forktree(ui, 'me/r', depth=2, ignore=['x/r']))
+    assert forks == ['a/r', 'b/r', 'c/r', 'd/r']
+    assert listed == ['me/r', 'a/r', 'b/r']
+
+
+def test_bundlecache_pull(monkeypatch, tmpdir, baseui):
+    local = make_repo(baseui, tmpdir.join('local'), ('a', 'shared'))
+    forkpath = str(tmpdir.join('fork'))
+    hg.clone(baseui, {}, local.root, forkpath)
+    make_commit(hg.repository(baseui, forkpath), 'b', 'fork only')
+    fake_peers(monkeypatch, {'bb://other/fork': forkpath})
+
+    bundles = hgbb.bundlecache(local, 1 << 20)
+    bundle = bundles.tempname('other/fork')
+    hgbb._scan_fork(local.ui, local, 'incoming', 'other/fork',
+                    {'template': '\xff'}, bundle)
+    bundles.add('other/fork', bundle)
+    assert hgbb.bundlecache(local, 0).lookup('other/fork')
+
+    # the kept changesets are applied as part of the pull, so that it still
+    # updates to them
+    monkeypatch.setattr(extensions, 'extensions', lambda: [('bb', hgbb)])
+    local = hg.repository(baseui, local.root)
+    assert hgbb.pull(commands.pull, local.ui, local, 'bb://other/fork',
+                     update=True) == 0
+    assert local['tip'].description() == 'fork only'
+    assert local['.'].description() == 'fork only'
+    assert not hgbb.bundlecache(local, 0).lookup('other/fork')
+    assert not hasattr(local, '_bbkept')
+
+    # nothing incoming, nothing kept
+    bundle = bundles.tempname('other/fork')
+    hgbb._scan_fork(local.ui, local, 'incoming', 'other/fork',
+                    {'template': '\xff'}, bundle)
+    bundles.add('other/fork', bundle)
+    assert not bundles.lookup('other/fork')
+
+
+def test_bundlecache_evict(tmpdir):
+    repo = Mock()
+    repo.join.side_effect = lambda name: str(tmpdir.join(name))
+    repo.opener.side_effect = IOError
+    bundles = hgbb.bundlecache(repo, 25)
+    for name in ('a/r', 'b/r', 'c/r'):
+        tempname = bundles.tempname(name)
+        open(tempname, 'wb').write('x' * 10)
+        bundles.add(name, tempname)
+    # the oldest bundle made room for the newest
+    assert not bundles.lookup('a/r')
+    assert bundles.lookup('b/r') and bundles.lookup('c/r')
+    bundles.discard('b/r')
+    assert not bundles.lookup('b/r')
+
+
+def test_autotransport(monkeypatch, tmpdir):
+    from mercurial import ui as uimod
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    ui = uimod.ui()
+    ui.setconfig('bb', 'default_method', 'auto')
+    peers = {}
+    def scheme(method, delay):
+        def instance(ui, url, create):
+            peer = peers[method] = Mock(name=method)
+            peer.heads.side_effect = lambda: hgbb.time.sleep(delay)
+            return peer
+        return Mock(instance=Mock(side_effect=instance))
+    schemes = {'bb+https': scheme('https', 0.05), 'bb+ssh': scheme('ssh', 0)}
+    monkeypatch.setattr(hg, 'schemes', schemes)
+
+    # the probed peer of the faster method is used, the other one closed
+    peer = hgbb.auto_bbrepo().instance(ui, 'bb://me/repo', False)
+    assert peer is peers['ssh']
+    assert peers['https'].close.called
+    assert tmpdir.join('hgbb', 'transports').check()
+
+    # later operations trust the remembered choice
+    schemes['bb+https'].instance.reset_mock()
+    hgbb.auto_bbrepo().instance(ui, 'bb://me/repo', False)
+    assert not schemes['bb+https'].instance.called
+    assert schemes['bb+ssh'].instance.call_count == 2
+
+    # until it is too old
+    ui.setconfig('bb', 'auto_method_ttl', '0')
+    schemes['bb+ssh'].instance.side_effect = util.Abort('no ssh here')
+    peer = hgbb.auto_bbrepo().instance(ui, 'bb://me/repo', False)
+    assert peer is peers['https']
+    assert hgbb.autotransport(ui).lookup() is None
+    ui.setconfig('bb', 'auto_method_ttl', '60')
+    assert hgbb.autotransport(ui).lookup() == 'https'
+
+
+def test_bbcreate_batch(monkeypatch, tmpdir):
+    from mercurial import ui as uimod
+    ui = uimod.ui()
+    ui.setconfig('ui', 'username', 'test')
+    ui.setconfig('bb', 'username', 'me')
+    ui.setconfig('bb', 'password', 'secret')
+    for name in ('one', 'two'):
+        repo = hg.repository(ui, str(tmpdir.join(name)), create=True)
+        make_commit(repo, 'a', name)
+    batch = tmpdir.join('batch')
+    batch.write('# to migrate\n%s language=Python private=yes\n'
+                '%s name=renamed\n%s\n'
+                % (tmpdir.join('one'), tmpdir.join('two'),
+                   tmpdir.join('missing')))
+    apicall = Mock()
+    monkeypatch.setattr(hgbb, '_bb_apicall', apicall)
+    pushed = []
+    peer = hg.peer
+    def fakepeer(uiorrepo, opts, path, create=False):
+        pushed.append(path)
+        return peer(uiorrepo, opts, str(tmpdir.join('remote-' + path[5:])),
+                    create=True)
+    monkeypatch.setattr(hg, 'peer', fakepeer)
+
+    ui.pushbuffer()
+    assert hgbb.bb_create(ui, batch=str(batch), description='migrated',
+                          jobs=2) == 1
+    output = ui.popbuffer()
+
+    created = sorted((c[0][2] for c in apicall.call_args_list),
+                     key=lambda data: data['name'])
+    assert [(d['name'], d['language'], d['description'], 'is_private' in d)
+            for d in created] == [('one', 'python', 'migrated', True),
+                                  ('renamed', '', 'migrated', False)]
+    assert sorted(pushed) == ['bb://one', 'bb://renamed']
+    remote = hg.repository(ui, str(tmpdir.join('remote-renamed')))
+    assert remote['tip'].description() == 'two'
+    assert 'created 2 of 3 repositories' in output
+
+    batch.write('%s\n%s name=one\n' % (tmpdir.join('one'), tmpdir.join('two')))
+    py.test.raises(util.Abort, hgbb.bb_create, ui, batch=str(batch))
+
+
+def test_bbfollowers(monkeypatch, tmpdir, ui):
+    import json
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(hgbb, 'get_bbreponame', Mock(return_value='me/r'))
+    everyone = [dict(username='u%d' % i, first_name='F', last_name=str(i))
+                for i in xrange(5)]
+    def apicall(ui, endpoint, data, use_pass=True, query=None):
+        assert endpoint == 'repositories/me/r/followers'
+        start, limit = query['start'], query['limit']
+        return json.dumps(dict(count=len(everyone),
+                               followers=everyone[start:start + limit]))
+    apicall = Mock(side_effect=apicall)
+    monkeypatch.setattr(hgbb, '_bb_apicall', apicall)
+    config = {('bb', 'followers_page_size'): 2, ('bb', 'api_workers'): 2}
+    ui.configint.side_effect = lambda section, name, default=None: \
+        config.get((section, name), default)
+
+    hgbb.bb_followers(ui, None)
+    lines = [c[0][0] for c in ui.write.call_args_list]
+    assert lines == ['List of followers:\n'] + [
+        '    u%d (F %d)\n' % (i, i) for i in xrange(5)]
+    assert sorted(c[0][4]['start'] for c in apicall.call_args_list) == [0, 2, 4]
+
+    # the second time, the cached list is used
+    ui.write.reset_mock()
+    apicall.reset_mock()
+    hgbb.bb_followers(ui, None, json=True)
+    assert not apicall.called
+    records = [json.loads(c[0][0]) for c in ui.write.call_args_list]
+    assert [r['username'] for r in records] == ['u%d' % i for i in xrange(5)]
+
+    hgbb.bb_followers(ui, None, refresh=True)
+    assert apicall.call_count == 3
+
+    # a server giving fewer followers than asked for loses none of them
+    config[('bb', 'followers_page_size')] = 3
+    def capped(ui, endpoint, data, use_pass=True, query=None):
+        start = query['start']
+        return json.dumps(dict(count=len(everyone),
+                               followers=everyone[start:start + 2]))
+    apicall.side_effect = capped
+    ui.write.reset_mock()
+    hgbb.bb_followers(ui, None, refresh=True, json=True)
+    assert len(ui.write.call_args_list) == 5
+
+
+def test_bbfollowers_no_repo(ui):
+    ui.configitems.return_value = []
+    py.test.raises(util.Abort, hgbb.bb_followers, ui, None)
+
+
+def test_prefetch_clone(monkeypatch, tmpdir, baseui):
+    baseui.setconfig('bb', 'username', 'me')
+    forkpath = str(tmpdir.join('fork'))
+    fork = make_repo(baseui, forkpath, ('a', 'bundled'))
+    tmpdir.join('store', 'other').ensure(dir=True)
+    commands.bundle(baseui, fork, str(tmpdir.join('store', 'other', 'fork.hg')),
+                    all=True)
+    make_commit(fork, 'b', 'newer')
+    fake_peers(monkeypatch, {'bb://other/fork': forkpath})
+    baseui.setconfig('bb', 'bundle_store', str(tmpdir.join('store')))
+    orig = Mock()
+    dest = str(tmpdir.join('dest'))
+
+    hgbb.clone(orig, baseui, 'bb:other/fork', dest)
+    assert not orig.called
+    clone = hg.repository(baseui, dest)
+    assert [clone[r].description() for r in clone] == ['bundled', 'newer']
+    assert clone.wopener.read('b') == 'newer'
+    assert clone.ui.config('paths', 'default') == 'bb://other/fork'
+
+    # a broken bundle leaves nothing behind, and a normal clone is made
+    tmpdir.join('store', 'other', 'broken.hg').write('HG10UNbroken')
+    hgbb.clone(orig, baseui, 'bb:other/broken', dest + '3')
+    orig.assert_called_with(baseui, 'bb://other/broken', dest + '3')
+    assert not tmpdir.join('dest3').check()
+    # neither does a failed pull of the newer changesets, for another try
+    monkeypatch.setattr(hgbb, '_finishclone', Mock(side_effect=IOError))
+    py.test.raises(IOError, hgbb._prefetchclone, baseui, 'bb://other/fork',
+                   dest + '4', str(tmpdir.join('store')))
+    assert not tmpdir.join('dest4').check()
+
+    # no bundle in the store: a normal clone, streaming if asked for
+    hgbb.clone(orig, baseui, 'bb:other/unknown', dest + '2', stream=True)
+    orig.assert_called_with(baseui, 'bb://other/unknown', dest + '2',
+                            uncompressed=True)
+
+
+def test_ratelimiter(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(hgbb.time, 'time', lambda: now[0])
+    limiter = hgbb.ratelimiter(2, 2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0.5
+    now[0] += 0.5
+    assert limiter.reserve() == 0
+    limiter.pause(3)
+    now[0] += 1
+    assert limiter.reserve() == 2
+    assert hgbb.ratelimiter(0, 1).reserve() == 0
+
+    assert hgbb._retryafter('7') == 7
+    assert hgbb._retryafter(None) is None
+    now[0] = 784111777 - 30
+    assert hgbb._retryafter('Sun, 06 Nov 1994 08:49:37 GMT') == 30
+    assert hgbb._retryafter('soon') is None
+
+
+class fakeconn(object):
+    """httplib connection answering with the given (status, headers, body)
+    responses in turn."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, method, path, data, headers):
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        status, headers, body = self.responses.pop(0)
+        response = Mock()
+        response.status = status
+        response.reason = 'reason %d' % status
+        response.msg = Mock(getheader=lambda name, default=None:
+                            headers.get(name, default))
+        response.getheader = response.msg.getheader
+        response.read = py.io.BytesIO(body).read
+        response.will_close = False
+        return response
+
+    def close(self):
+        pass
+
+
+def test_bbsession_retry(monkeypatch):
+    now = [1000.0]
+    def sleep(seconds):
+        now[0] += seconds
+    sleep = Mock(side_effect=sleep)
+    monkeypatch.setattr(hgbb.time, 'time', lambda: now[0])
+    monkeypatch.setattr(hgbb.time, 'sleep', sleep)
+    conn = fakeconn([(429, {'Retry-After': '3'}, 'slow down'),
+                     (503, {}, 'busy'),
+                     (200, {}, 'ok')])
+    session = hgbb.bbsession()
+    getconn = Mock(return_value=(conn, False))
+    monkeypatch.setattr(session, '_getconn', getconn)
+    response = session.request('https://bitbucket.org/x')
+    assert response.status == 200
+    assert response.read() == 'ok'
+    assert len(conn.requests) == 3
+    # waited as told, then backed off by itself
+    assert [c[0][0] for c in sleep.call_args_list] == [3, 2]
+
+    # a POST is only repeated when it was refused
+    conn.responses = [(503, {}, 'busy')]
+    assert session.request('https://bitbucket.org/x', 'data').status == 503
+
+    # a GET is sent again after a kept-alive connection failed, a POST
+    # always gets a fresh connection and is never sent again
+    import socket
+    conn.request = Mock(side_effect=[socket.error, None])
+    conn.responses = [(200, {}, 'ok')]
+    getconn.return_value = (conn, True)
+    assert session.request('https://bitbucket.org/y').read() == 'ok'
+    assert conn.request.call_count == 2
+    conn.request = Mock(side_effect=socket.error)
+    getconn.reset_mock()
+    getconn.return_value = (conn, False)
+    py.test.raises(socket.error, session.request,
+                   'https://bitbucket.org/x', 'data')
+    getconn.assert_called_once_with(('https', 'bitbucket.org'), False)
+    assert conn.request.call_count == 1
+
+
+def test_bbsession_proxy(monkeypatch):
+    from mercurial import ui as uimod
+    for name in ('http_proxy', 'https_proxy', 'no_proxy'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('https_proxy', 'http://envproxy:3128')
+    session = hgbb.bbsession(uimod.ui())
+    conn, reused = session._getconn(('https', 'bitbucket.org'))
+    assert (conn.host, conn.port) == ('envproxy', 3128)
+    assert conn._tunnel_host == 'bitbucket.org'
+    assert session._proxy(('https', 'localhost:8000')) is None
+
+    # Mercurial's own setting wins, and a plain HTTP proxy gets the URL
+    baseui = uimod.ui()
+    baseui.setconfig('http_proxy', 'host', 'hgproxy:8080')
+    baseui.setconfig('http_proxy', 'user', 'me')
+    baseui.setconfig('http_proxy', 'passwd', 'secret')
+    baseui.setconfig('http_proxy', 'no', 'api.example.org')
+    session = hgbb.bbsession(baseui)
+    assert session._proxy(('https', 'api.example.org')) is None
+    conn = fakeconn([(200, {}, 'ok')])
+    conn.request = Mock()
+    monkeypatch.setattr(session, '_getconn', Mock(return_value=(conn, False)))
+    assert session.request('http://bitbucket.org/x?a=1').read() == 'ok'
+    method, path, data, headers = conn.request.call_args[0]
+    assert path == 'http://bitbucket.org/x?a=1'
+    assert headers['Proxy-Authorization'] == 'Basic bWU6c2VjcmV0'
+
+
+def test_bbsession_coalesce(monkeypatch):
+    import threading
+    waiting = threading.Event()
+    def tracestart(name, target=''):
+        if name == 'coalesced':
+            waiting.set()
+    monkeypatch.setattr(hgbb, '_tracestart', tracestart)
+    conn = fakeconn([(200, {}, 'page' * 1000)])
+    session = hgbb.bbsession()
+    monkeypatch.setattr(session, '_getconn',
+                        lambda key, reuse=True: (conn, False))
+    leader = session.request('https://bitbucket.org/x')
+    results = []
+    def follow():
+        response = session.request('https://bitbucket.org/x')
+        results.append((response.status, response.read()))
+    thread = threading.Thread(target=follow)
+    thread.start()
+    waiting.wait(5)
+    # the identical request waits for the response of the first one
+    assert leader.read() == 'page' * 1000
+    thread.join()
+    assert results == [(200, 'page' * 1000)]
+    assert len(conn.requests) == 1
+    assert not session._inflight
+
+
+def test_bbforks_active_since(monkeypatch, tmpdir, ui):
+    import json
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(hgbb, 'iter_forks',
+                        Mock(return_value=['a/r', 'b/r', 'c/r', 'd/r']))
+    monkeypatch.setattr(hgbb, 'get_bbreponame', Mock(return_value='me/r'))
+    updated = {'a/r': '2010-01-01 10:00:00', 'b/r': '2026-03-01 10:00:00',
+               'c/r': '2026-05-01 10:00:00'}
+    def apicall(ui, endpoint, data, use_pass=True, query=None):
+        name = endpoint.split('/', 1)[1]
+        if name == 'd/r':
+            raise IOError('gone')
+        return json.dumps(dict(last_updated=updated[name], size=10))
+    apicall = Mock(side_effect=apicall)
+    monkeypatch.setattr(hgbb, '_bb_apicall', apicall)
+
+    hgbb.bb_forks(ui, None, active_since='2026-01-01')
+    listed = [c[0][0] for c in ui.status.call_args_list
+              if c[0][0].startswith('bb://')]
+    # the fork without metadata is kept
+    assert listed == ['bb://b/r\n', 'bb://c/r\n', 'bb://d/r\n']
+    assert apicall.call_count == 4
+
+    # newest first; the metadata comes from the cache
+    ui.status.reset_mock()
+    hgbb.bb_forks(ui, None, limit=2)
+    listed = [c[0][0] for c in ui.status.call_args_list
+              if c[0][0].startswith('bb://')]
+    assert listed == ['bb://c/r\n', 'bb://b/r\n']
+    assert apicall.call_count == 5
+
+
+def test_outgoing_single_pass(monkeypatch, tmpdir, baseui):
+    from mercurial import discovery
+    local = make_repo(baseui, tmpdir.join('local'), ('a', 'shared'))
+    # a fork that is behind, one with changesets of its own, one up to date
+    forkpaths = {}
+    for name in ('old', 'own', 'same'):
+        forkpaths['bb://other/' + name] = str(tmpdir.join(name))
+    hg.clone(baseui, {}, local.root, forkpaths['bb://other/old'])
+    make_commit(local, 'b', 'local 1')
+    commands.update(baseui, local, '0')
+    make_commit(local, 'c', 'local 2')
+    commands.merge(baseui, local)
+    commands.commit(baseui, local, message='merged')
+    hg.clone(baseui, {}, local.root, forkpaths['bb://other/own'], update=True)
+    own = hg.repository(baseui, forkpaths['bb://other/own'])
+    make_commit(own, 'd', 'fork only')
+    make_commit(local, 'e', 'local 3')
+    hg.clone(baseui, {}, local.root, forkpaths['bb://other/same'])
+    # other/gone is not there
+    peers = dict(forkpaths)
+    peers['bb://other/gone'] = str(tmpdir.join('gone'))
+    fake_peers(monkeypatch, peers)
+
+    names = ['other/old', 'other/own', 'other/gone', 'other/same']
+    commons = [hgbb._commonheads(baseui, local, hg.peer(baseui, {}, path))
+               for path in sorted(forkpaths)]
+    missing = hgbb._missing_revs(
+        local, [[local.changelog.rev(n) for n in nodes] for nodes in commons])
+    for path, revs in zip(sorted(forkpaths), missing):
+        outgoing = discovery.findcommonoutgoing(local, hg.peer(baseui, {},
+                                                               path))
+        expected = sorted((local[n].rev() for n in outgoing.missing),
+                          reverse=True)
+        assert revs == expected
+    assert map(len, missing) == [4, 1, 0]
+
+    baseui.setconfig('ui', 'quiet', 'False')
+    baseui.pushbuffer()
+    hgbb._outgoing_forks(baseui, local, names, {'full': True})
+    output = baseui.popbuffer()
+    assert '4 outgoing changesets found in bb://other/old' in output
+    assert '1 outgoing changeset found in bb://other/own' in output
+    assert 'local 3' in output.split('bb://other/own')[1]
+    assert 'found in bb://other/same' not in output
+    assert output.index('looking at other/gone') < \
+        output.index('looking at other/same')
+
+
+def test_bbproxy(monkeypatch, tmpdir, baseui):
+    import threading
+    from wsgiref import simple_server
+    from mercurial.hgweb import hgweb_mod
+    upstream = make_repo(baseui, tmpdir.join('upstream'), ('a', 'first'))
+    upstream.opener.write('hgrc', '[web]\npush_ssl = False\nallow_push = *\n')
+
+    # bitbucket, serving the repository as owner/repo
+    requests = []
+    app = hgweb_mod.hgweb(upstream.root, baseui=baseui)
+    def bitbucket(environ, start_response):
+        requests.append(environ['QUERY_STRING'])
+        environ['SCRIPT_NAME'] = '/owner/repo'
+        environ['PATH_INFO'] = ''
+        return app(environ, start_response)
+    class quiethandler(simple_server.WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+    bbserver = simple_server.make_server('127.0.0.1', 0, bitbucket,
+                                         handler_class=quiethandler)
+    threading.Thread(target=bbserver.serve_forever).start()
+    monkeypatch.setattr(hgbb, '_session', None)
+    baseui.setconfig('bb', 'url', 'http://127.0.0.1:%d' %
+                     bbserver.server_address[1])
+    baseui.setconfig('bb', 'proxy_cache_dir', str(tmpdir.join('cache')))
+    httpd = hgbb.proxyserver(baseui, '127.0.0.1', 0)
+    threading.Thread(target=httpd.serve_forever).start()
+    try:
+        proxyurl = 'http://127.0.0.1:%d/owner/repo' % httpd.server_address[1]
+        hg.clone(baseui, {}, proxyurl, str(tmpdir.join('c1')))
+        seen = len(requests)
+        # everything comes from the cache the second time
+        hg.clone(baseui, {}, proxyurl, str(tmpdir.join('c2')))
+        assert len(requests) == seen
+        assert len([q for q in requests if 'getbundle' in q]) == 1
+
+        # a push goes through and makes the heads come from bitbucket again
+        c2 = hg.repository(baseui, str(tmpdir.join('c2')))
+        make_commit(c2, 'b', 'second')
+        commands.push(baseui, c2, proxyurl)
+        upstream = hg.repository(baseui, upstream.root)
+        assert upstream['tip'].description() == 'second'
+        c1 = hg.repository(baseui, str(tmpdir.join('c1')))
+        commands.pull(baseui, c1, proxyurl)
+        assert c1['tip'].description() == 'second'
+    finally:
+        httpd.shutdown()
+        bbserver.shutdown()
+
+    # bb:// URLs go through the proxy when it is configured
+    factory = Mock()
+    monkeypatch.setattr(hgbb, 'httprepo_instance', factory)
+    baseui.setconfig('bb', 'username', 'me')
+    baseui.setconfig('bb', 'proxy', 'http://cache:8000')
+    maker = hgbb.bbrepo(factory, '%(scheme)s://%(host)s/%(path)s')
+    maker.instance(baseui, 'bb://owner/repo', False)
+    factory.assert_called_with(baseui, 'http://cache:8000/owner/repo/', False)
+
+
+def test_proxycache(monkeypatch, tmpdir):
+    now = [1000.0]
+    monkeypatch.setattr(hgbb.time, 'time', lambda: now[0])
+    cache = hgbb.proxycache(str(tmpdir), 25)
+    for key, ttl in (('a', None), ('b', 30), ('c', None)):
+        tempname = cache.tempname(key)
+        open(tempname, 'wb').write('x' * 10)
+        cache.add(key, tempname, [('content-type', 'x')], 'owner/repo', ttl)
+        now[0] += 1
+    # the least recently served response made room for the newest
+    assert cache.lookup('a') is None
+    headers, filename = cache.lookup('b')
+    assert headers == [('content-type', 'x')]
+    assert open(filename).read() == 'x' * 10
+    # the index survives, and expiring responses expire
+    cache = hgbb.proxycache(str(tmpdir), 25)
+    assert cache.lookup('c')
+    now[0] += 30
+    assert cache.lookup('b') is None
+    assert cache.lookup('c')